@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Benchmark of the WAV decoder. A TZX file is rendered to audio, degraded in
+# a controlled way, and then decoded again. Decoding speed and the number of
+# recovered blocks are reported.
+#
+# Invoke from the project directory: python3 -m benchmark.tapebench
+#
+
+import argparse
+import numpy
+import os
+import sys
+import tempfile
+from time import perf_counter
+import wave
+
+from tzxlib.loader import TapeLoader, PulseLoader
+from tzxlib.tapfile import TapFile
+from tzxlib.tzxblocks import TzxbData
+from tzxlib.tzxfile import TzxFile
+from tzxtools.tzxplay import streamAudio
+from tzxtools.tzxwav import tresholds, tolerances
+
+
+class Scenario():
+    """ Describes how the rendered signal is degraded and stored """
+
+    def __init__(self, name, rate=44100, sine=False, width=2, channels=1, degrade=None):
+        self.name = name
+        self.rate = rate
+        self.sine = sine
+        self.width = width
+        self.channels = channels
+        self.degrade = degrade
+
+    def render(self, tzx, rng):
+        """ Renders the TZX file, returns the degraded signal as float array """
+        data = b''.join(bytes(b) for b in streamAudio(tzx, rate=self.rate, sine=self.sine))
+        signal = numpy.frombuffer(data, dtype='<i2').astype(numpy.float64)
+        signal = numpy.concatenate((signal, numpy.zeros(self.rate // 2)))
+        if self.degrade is not None:
+            signal = self.degrade(signal, self.rate, rng)
+        return signal
+
+    def write(self, filename, signal, rng):
+        """ Writes the signal to a WAV file of the scenario's format """
+        if self.channels == 2:
+            # The tape signal is on the left channel, the right channel is hiss
+            frames = numpy.empty(len(signal) * 2)
+            frames[0::2] = signal
+            frames[1::2] = rng.normal(0, 2000, len(signal))
+        else:
+            frames = signal
+        if self.width == 1:
+            data = (numpy.clip(frames / 256, -128, 127).astype(numpy.int16) + 128).astype(numpy.uint8)
+        else:
+            data = numpy.clip(frames, -32768, 32767).astype('<i2')
+        with wave.open(filename, 'wb') as w:
+            w.setnchannels(self.channels)
+            w.setsampwidth(self.width)
+            w.setframerate(self.rate)
+            w.writeframes(data.tobytes())
+
+
+def noise(level):
+    return lambda s, rate, rng: s + rng.normal(0, level, len(s))
+
+def dcOffset(offset):
+    return lambda s, rate, rng: s + offset
+
+def amplitude(factor):
+    return lambda s, rate, rng: s * factor
+
+def amplitudeDrop(factor):
+    """ Amplitude slowly drops to the given factor and recovers again """
+    def degrade(s, rate, rng):
+        envelope = 1 - (1 - factor) * (1 - numpy.cos(numpy.linspace(0, 2 * numpy.pi, len(s)))) / 2
+        return s * envelope
+    return degrade
+
+def wowFlutter(wow, flutter):
+    """ Modulates the tape speed by a slow wow and a fast flutter, relative depth """
+    def degrade(s, rate, rng):
+        t = numpy.arange(len(s)) / rate
+        speed = 1 + wow * numpy.sin(2 * numpy.pi * 0.5 * t) + flutter * numpy.sin(2 * numpy.pi * 8 * t)
+        pos = numpy.cumsum(speed)
+        pos = pos[pos < len(s) - 1]
+        return numpy.interp(pos, numpy.arange(len(s)), s)
+    return degrade
+
+def combined(*degrades):
+    def degrade(s, rate, rng):
+        for d in degrades:
+            s = d(s, rate, rng)
+        return s
+    return degrade
+
+
+scenarios = [
+    Scenario('clean'),
+    Scenario('sine', sine=True),
+    Scenario('noise', sine=True, degrade=noise(3000)),
+    Scenario('heavy-noise', sine=True, degrade=combined(amplitude(0.5), noise(4000))),
+    Scenario('dc-offset', sine=True, degrade=dcOffset(6000)),
+    Scenario('inverted', sine=True, degrade=amplitude(-0.8)),
+    Scenario('quiet', sine=True, degrade=amplitude(0.15)),
+    Scenario('amp-drop', sine=True, degrade=amplitudeDrop(0.1)),
+    Scenario('wow-flutter', sine=True, degrade=wowFlutter(0.03, 0.01)),
+    Scenario('8bit', sine=True, width=1, degrade=amplitude(0.7)),
+    Scenario('stereo', sine=True, channels=2, degrade=amplitude(0.6)),
+    Scenario('22050', rate=22050, sine=True),
+    Scenario('48000', rate=48000, sine=True),
+    Scenario('96000', rate=96000, sine=True),
+    Scenario('tape', sine=True, degrade=combined(wowFlutter(0.02, 0.005), amplitude(0.4), dcOffset(-1500), noise(1500))),
+]
+
+
+def syntheticTzx(seed):
+    """ Creates a TZX file with a header, a screen and a code block of random content """
+    rng = numpy.random.default_rng(seed)
+    tzx = TzxFile()
+    header = bytearray(b'\x00\x03benchmark ')
+    header += (6912).to_bytes(2, 'little') + (16384).to_bytes(2, 'little') + (32768).to_bytes(2, 'little')
+    for content in (header, b'\xff' + rng.integers(0, 256, 6912, dtype=numpy.uint8).tobytes(),
+                    b'\xff' + rng.integers(0, 256, 16384, dtype=numpy.uint8).tobytes()):
+        data = bytearray(content)
+        checksum = 0
+        for b in data:
+            checksum ^= b
+        data.append(checksum)
+        block = TzxbData()
+        block.setup(TapFile.create(data))
+        tzx.blocks.append(block)
+    return tzx
+
+
+def expectedBlocks(tzx):
+    """ Returns the data of all blocks that are expected to be recovered """
+    return [bytes(b.tap.data) for b in tzx.blocks if isinstance(b, TzxbData)]
+
+
+def decode(loaderClass, filename, treshold, tolerance):
+    """ Decodes the WAV file, returns the decoded blocks and the elapsed time """
+    loader = loaderClass(treshold=tresholds[treshold], tolerance=tolerances[tolerance], leaderMin=20)
+    start = perf_counter()
+    tzx = loader.load(filename)
+    return (tzx, perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the WAV decoder')
+    parser.add_argument('file',
+                nargs='?',
+                type=argparse.FileType('rb'),
+                help='TZX file to be rendered, a synthetic tape is used if omitted')
+    parser.add_argument('-s', '--scenario',
+                dest='scenarios',
+                action='append',
+                choices=[s.name for s in scenarios],
+                help='run the given scenario only, may be given multiple times')
+    parser.add_argument('-t', '--treshold',
+                dest='tresholds',
+                action='append',
+                choices=tresholds.keys(),
+                help='treshold preset to compare, may be given multiple times')
+    parser.add_argument('-T', '--tolerance',
+                dest='tolerances',
+                action='append',
+                choices=tolerances.keys(),
+                help='tolerance preset to compare, may be given multiple times')
+    parser.add_argument('-F', '--fast',
+                dest='fast',
+                action='store_true',
+                help='also benchmark the fast decoder')
+    parser.add_argument('-r', '--repeat',
+                dest='repeat',
+                default=1,
+                type=int,
+                help='number of runs, the fastest run is reported')
+    parser.add_argument('--seed',
+                dest='seed',
+                default=1982,
+                type=int,
+                help='seed of the random generator')
+    args = parser.parse_args()
+
+    if args.file is not None:
+        tzx = TzxFile()
+        tzx.read(args.file)
+    else:
+        tzx = syntheticTzx(args.seed)
+    expected = expectedBlocks(tzx)
+
+    selected = [s for s in scenarios if args.scenarios is None or s.name in args.scenarios]
+    loaders = [('sample', TapeLoader)]
+    if args.fast:
+        loaders.append(('fast', PulseLoader))
+    presets = [(tr, to) for tr in (args.tresholds or ['med']) for to in (args.tolerances or ['med'])]
+
+    print('{:12s} {:6s} {:4s} {:4s} {:>8s} {:>10s} {:>8s} {:>7s} {:>5s}'.format(
+            'Scenario', 'Loader', 'Tres', 'Tol', 'Seconds', 'Frames/s', 'RT-Fact', 'Blocks', 'CRC'))
+
+    totalBlocks = totalFound = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for scenario in selected:
+            rng = numpy.random.default_rng(args.seed)
+            filename = os.path.join(tmp, scenario.name + '.wav')
+            signal = scenario.render(tzx, rng)
+            scenario.write(filename, signal, rng)
+            audioSeconds = len(signal) / scenario.rate
+
+            for (loaderName, loaderClass) in loaders:
+                for (treshold, tolerance) in presets:
+                    elapsed = None
+                    for _ in range(max(args.repeat, 1)):
+                        (result, duration) = decode(loaderClass, filename, treshold, tolerance)
+                        elapsed = duration if elapsed is None else min(elapsed, duration)
+
+                    decoded = [bytes(b.tap.data) for b in result.blocks]
+                    found = sum(1 for e in expected if e in decoded)
+                    valid = sum(1 for b in result.blocks if b.valid())
+                    totalBlocks += len(expected)
+                    totalFound += found
+
+                    print('{:12s} {:6s} {:4s} {:4s} {:8.3f} {:10.0f} {:8.1f} {:>7s} {:>5s}'.format(
+                            scenario.name,
+                            loaderName,
+                            treshold,
+                            tolerance,
+                            elapsed,
+                            len(signal) / elapsed,
+                            audioSeconds / elapsed,
+                            '{}/{}'.format(found, len(expected)),
+                            '{}/{}'.format(valid, len(result.blocks))))
+                    sys.stdout.flush()
+
+    if totalBlocks > 0:
+        print('Recovery rate: {:.1f}%'.format(totalFound * 100 / totalBlocks))
+
+
+if __name__ == '__main__':
+    main()
@@ -70,11 +70,13 @@ setup(
             'tzxcat=tzxtools.tzxcat:main',
             'tzxcleanup=tzxtools.tzxcleanup:main',
             'tzxcut=tzxtools.tzxcut:main',
+            'tzxindex=tzxtools.tzxindex:main',
             'tzxls=tzxtools.tzxls:main',
             'tzxmerge=tzxtools.tzxmerge:main',
             'tzxplay=tzxtools.tzxplay:main',
             'tzxsplit=tzxtools.tzxsplit:main',
             'tzxtap=tzxtools.tzxtap:main',
+            'tzxtrace=tzxtools.tzxtrace:main',
             'tzxwav=tzxtools.tzxwav:main',
         ],
     },
@@ -0,0 +1,192 @@
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+import hashlib
+import io
+import os
+from struct import pack, unpack, error as StructError
+import tempfile
+import numpy
+
+CACHE_VERSION = 3
+
+# Header of a cache file: ticks, end state, sample type and number of samples
+HEADER = '<QB2sQ'
+HEADER_SIZE = 19
+DTYPES = { b'f4': numpy.dtype('<f4'), b'i2': numpy.dtype('<i2') }
+
+class RenderedAudio():
+    """
+    Audio of a rendered block, with the number of ticks the saver position has
+    advanced, and the signal state at the end of the block
+    """
+
+    def __init__(self, samples, ticks, endState):
+        self.samples = samples
+        self.ticks = ticks
+        self.endState = endState
+
+    def size(self):
+        return self.samples.nbytes
+
+
+class AudioCache():
+    """
+    A least recently used cache of rendered audio. Entries are kept in memory,
+    and optionally also in a directory, so they can be shared between processes
+    and runs. Both caches are limited in size, the least recently used entries
+    are evicted first.
+    """
+
+    def __init__(self, maxBytes=64 * 1024 * 1024, directory=None, maxDiskBytes=512 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.directory = directory
+        self.maxDiskBytes = maxDiskBytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.diskSize = None
+
+    def get(self, key):
+        """ Returns the cached value of the key, or None if not cached """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.directory is not None and isinstance(key, str):
+            value = self._readFile(key)
+            if value is not None:
+                self._putMemory(key, value)
+            return value
+        return None
+
+    def put(self, key, value):
+        """ Stores a value. Only string keys are stored on disk. """
+        self._putMemory(key, value)
+        if self.directory is not None and isinstance(key, str):
+            self._writeFile(key, value)
+
+    def blockKey(self, block, rate, cpufreq, sine, npy, startState, phase, variant=''):
+        """
+        Returns the key of a rendered block. Besides the block content and the
+        render settings, the rendering depends on the starting signal level, on
+        the phase of the block start relative to the sample clock (the saver
+        ticks modulo cpufreq), and on the variant of the saver.
+        """
+        content = io.BytesIO()
+        block.write(content)
+        digest = hashlib.sha256(content.getvalue())
+        digest.update(pack('<BLLBBBQ', CACHE_VERSION, rate, cpufreq, sine, npy, startState, phase))
+        digest.update(variant.encode('ascii'))
+        return digest.hexdigest()
+
+    def _putMemory(self, key, value):
+        size = self._sizeOf(value)
+        if size > self.maxBytes // 4:
+            return  # too large for being cached
+        if key in self.entries:
+            self.size -= self._sizeOf(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.maxBytes:
+            (_, evicted) = self.entries.popitem(last=False)
+            self.size -= self._sizeOf(evicted)
+
+    def _sizeOf(self, value):
+        if isinstance(value, RenderedAudio):
+            return value.size()
+        return len(value) if isinstance(value, bytes) else value.nbytes
+
+    def _fileName(self, key):
+        return os.path.join(self.directory, key + '.pcm')
+
+    def _readFile(self, key):
+        """ Reads a cache file. A bad file is deleted, and treated as not cached. """
+        fileName = self._fileName(key)
+        try:
+            with open(fileName, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            (ticks, endState, dtype, count) = unpack(HEADER, data[0:HEADER_SIZE])
+            dtype = DTYPES[dtype]
+            if len(data) != HEADER_SIZE + count * dtype.itemsize:
+                raise ValueError('bad length')
+            samples = numpy.frombuffer(data, dtype=dtype, offset=HEADER_SIZE)
+        except (KeyError, ValueError, StructError):
+            self._removeFile(fileName)
+            return None
+        try:
+            os.utime(fileName)  # mark as recently used
+        except OSError:
+            pass
+        return RenderedAudio(samples, ticks, endState == 1)
+
+    def _writeFile(self, key, value):
+        """ Writes a cache file. Writing is best effort, errors are ignored. """
+        tmpName = None
+        try:
+            if self.diskSize is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.diskSize = sum(size for (_, size, _) in self._scanFiles())
+            dtype = b'f4' if value.samples.dtype == numpy.float32 else b'i2'
+            (fd, tmpName) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pack(HEADER, value.ticks, value.endState, dtype, len(value.samples)))
+                f.write(value.samples.tobytes())
+            os.replace(tmpName, self._fileName(key))    # atomic, other processes may read it
+        except OSError:
+            if tmpName is not None:
+                self._removeFile(tmpName)
+            return
+        self.diskSize += HEADER_SIZE + value.size()
+        if self.diskSize > self.maxDiskBytes:
+            self._evictFiles()
+
+    def _evictFiles(self):
+        files = sorted(self._scanFiles())
+        self.diskSize = sum(f[1] for f in files)
+        for (_, size, path) in files:
+            if self.diskSize <= self.maxDiskBytes * 3 // 4:
+                break
+            self._removeFile(path)
+            self.diskSize -= size
+
+    def _scanFiles(self):
+        """ Returns the modification time, size and path of all cache files """
+        files = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return files
+        for e in entries:
+            if e.name.endswith('.pcm'):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue    # removed by another process meanwhile
+                files.append((st.st_mtime, st.st_size, e.path))
+        return files
+
+    def _removeFile(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,229 @@
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import io
+import os
+import sqlite3
+
+from tzxlib.tapfile import TapHeader
+from tzxlib.tzxblocks import TzxbArchiveInfo
+from tzxlib.tzxfile import TzxFile
+
+CATALOG_VERSION = 1
+
+# Results of Catalog.update()
+ADDED     = 'added'         # file was read and added
+UPDATED   = 'updated'       # file content has changed and was read again
+COPIED    = 'copied'        # file content was already known, blocks were copied
+UNCHANGED = 'unchanged'     # file content is unchanged
+FAILED    = 'failed'        # file could not be read
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id          INTEGER PRIMARY KEY,
+    path        TEXT NOT NULL UNIQUE,
+    size        INTEGER NOT NULL,
+    mtime       INTEGER NOT NULL,
+    hash        TEXT NOT NULL,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+
+CREATE TABLE IF NOT EXISTS blocks (
+    file        INTEGER NOT NULL,
+    number      INTEGER NOT NULL,
+    id          INTEGER NOT NULL,
+    type        TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    hash        TEXT NOT NULL,
+    description TEXT NOT NULL,
+    valid       INTEGER,
+    headerType  INTEGER,
+    name        TEXT COLLATE NOCASE,
+    param1      INTEGER,
+    param2      INTEGER,
+    length      INTEGER,
+    PRIMARY KEY (file, number)
+);
+CREATE INDEX IF NOT EXISTS blocks_name ON blocks (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS blocks_hash ON blocks (hash);
+
+CREATE TABLE IF NOT EXISTS archive (
+    file        INTEGER NOT NULL,
+    number      INTEGER NOT NULL,
+    field       TEXT NOT NULL,
+    value       TEXT NOT NULL COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS archive_file ON archive (file);
+CREATE INDEX IF NOT EXISTS archive_value ON archive (value COLLATE NOCASE);
+'''
+
+BLOCK_COLUMNS = 'number, id, type, size, hash, description, valid, headerType, name, param1, param2, length'
+
+
+class Catalog():
+    """
+    A SQLite catalog of the blocks of a collection of TZX and TAP files. Files
+    are only read again if their size or modification time has changed, and
+    files with known content are not parsed again.
+    """
+
+    def __init__(self, database):
+        self.db = sqlite3.connect(database)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0:
+            self.db.executescript(SCHEMA)
+            self.db.execute('PRAGMA user_version = %d' % (CATALOG_VERSION))
+        elif version != CATALOG_VERSION:
+            raise IOError('Cannot handle catalog version %d' % (version))
+
+    def update(self, path):
+        """ Updates the catalog entry of a file, returns how the file was handled """
+        path = os.path.abspath(path)
+        row = self.db.execute('SELECT id, size, mtime, hash FROM files WHERE path = ?', (path,)).fetchone()
+        try:
+            stat = os.stat(path)
+            if row is not None and row[1] == stat.st_size and row[2] == stat.st_mtime_ns:
+                return UNCHANGED
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as ex:
+            # Keep the file in the catalog, so the error can be queried
+            error = ex.strerror or str(ex)
+            if row is None:
+                self.db.execute('INSERT INTO files (path, size, mtime, hash, error) VALUES (?, -1, -1, \'\', ?)', (path, error))
+            elif row[1] == -1:
+                self.db.execute('UPDATE files SET error = ? WHERE id = ?', (error, row[0]))
+                return UNCHANGED    # could not be read before either
+            else:
+                self._deleteBlocks(row[0])
+                self.db.execute('UPDATE files SET size = -1, mtime = -1, hash = \'\', error = ? WHERE id = ?', (error, row[0]))
+            return FAILED
+        digest = hashlib.sha256(data).hexdigest()
+
+        if row is not None:
+            self.db.execute('UPDATE files SET size = ?, mtime = ? WHERE id = ?', (stat.st_size, stat.st_mtime_ns, row[0]))
+            if row[3] == digest:
+                return UNCHANGED
+            self._deleteBlocks(row[0])
+            self.db.execute('UPDATE files SET hash = ?, error = NULL WHERE id = ?', (digest, row[0]))
+            fileId = row[0]
+        else:
+            fileId = self.db.execute('INSERT INTO files (path, size, mtime, hash) VALUES (?, ?, ?, ?)',
+                    (path, stat.st_size, stat.st_mtime_ns, digest)).lastrowid
+
+        same = self.db.execute('SELECT id FROM files WHERE hash = ? AND id != ? AND error IS NULL LIMIT 1', (digest, fileId)).fetchone()
+        if same is not None:
+            self.db.execute('INSERT INTO blocks (file, %s) SELECT ?, %s FROM blocks WHERE file = ?' % (BLOCK_COLUMNS, BLOCK_COLUMNS), (fileId, same[0]))
+            self.db.execute('INSERT INTO archive (file, number, field, value) SELECT ?, number, field, value FROM archive WHERE file = ?', (fileId, same[0]))
+            return COPIED
+
+        try:
+            tzx = TzxFile()
+            tzx.read(io.BytesIO(data))
+            self._insertBlocks(fileId, tzx)
+        except Exception as ex:
+            # A single broken file must not abort the scan of a collection
+            self._deleteBlocks(fileId)
+            self.db.execute('UPDATE files SET error = ? WHERE id = ?', (str(ex) or type(ex).__name__, fileId))
+            return FAILED
+        return ADDED if row is None else UPDATED
+
+    def remove(self, path):
+        """ Removes a file from the catalog """
+        row = self.db.execute('SELECT id FROM files WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        if row is not None:
+            self._deleteBlocks(row[0])
+            self.db.execute('DELETE FROM files WHERE id = ?', (row[0],))
+
+    def paths(self, directory):
+        """ Returns the paths of all files in the catalog that are below the directory """
+        prefix = os.path.join(os.path.abspath(directory), '')
+        rows = self.db.execute('SELECT path FROM files WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+        return [r[0] for r in rows]
+
+    def findHeaders(self, pattern='*', headerType=None):
+        """ Finds all headers with a name matching the glob pattern, ignoring case """
+        query = 'SELECT f.path, b.number, b.description FROM blocks b JOIN files f ON f.id = b.file' \
+                ' WHERE b.name LIKE ? ESCAPE \'\\\''
+        params = [globToLike(pattern)]
+        if headerType is not None:
+            query += ' AND b.headerType = ?'
+            params.append(headerType)
+        return self.db.execute(query + ' ORDER BY f.path, b.number', params).fetchall()
+
+    def findInfo(self, pattern):
+        """ Finds all archive info entries with a text matching the glob pattern, ignoring case """
+        return self.db.execute('SELECT f.path, a.number, a.field, a.value FROM archive a JOIN files f ON f.id = a.file'
+                ' WHERE a.value LIKE ? ESCAPE \'\\\' ORDER BY f.path, a.number', (globToLike(pattern),)).fetchall()
+
+    def findBlocks(self, prefix):
+        """ Finds all blocks with a content hash starting with the given hex digits """
+        prefix = prefix.lower()
+        return self.db.execute('SELECT f.path, b.number, b.type, b.description FROM blocks b JOIN files f ON f.id = b.file'
+                ' WHERE b.hash >= ? AND b.hash < ? ORDER BY f.path, b.number', (prefix, prefix + 'g')).fetchall()
+
+    def findErrors(self):
+        """ Finds all files that could not be read, and all blocks with a bad CRC """
+        return self.db.execute('SELECT path, NULL, error FROM files WHERE error IS NOT NULL'
+                ' UNION ALL SELECT f.path, b.number, b.description FROM blocks b JOIN files f ON f.id = b.file'
+                ' WHERE b.valid = 0 ORDER BY 1, 2').fetchall()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _deleteBlocks(self, fileId):
+        self.db.execute('DELETE FROM blocks WHERE file = ?', (fileId,))
+        self.db.execute('DELETE FROM archive WHERE file = ?', (fileId,))
+
+    def _insertBlocks(self, fileId, tzx):
+        blocks = []
+        archive = []
+        for (number, b) in enumerate(tzx.blocks):
+            content = io.BytesIO()
+            b.write(content)
+            row = [fileId, number, b.id, b.type, len(content.getvalue()), hashlib.sha256(content.getvalue()).hexdigest(),
+                   str(b), None, None, None, None, None, None]
+            if hasattr(b, 'tap'):
+                row[7] = b.tap.valid()
+                if isinstance(b.tap, TapHeader):
+                    row[8:13] = [b.tap.typeId(), b.tap.name().rstrip(), b.tap.param1(), b.tap.param2(), b.tap.length()]
+            if isinstance(b, TzxbArchiveInfo):
+                archive.extend((fileId, number, field, value.strip()) for (field, value) in b.entries())
+            blocks.append(row)
+        self.db.executemany('INSERT INTO blocks (file, %s) VALUES (?%s)' % (BLOCK_COLUMNS, ', ?' * 12), blocks)
+        self.db.executemany('INSERT INTO archive (file, number, field, value) VALUES (?, ?, ?, ?)', archive)
+
+
+def globToLike(pattern):
+    """ Converts a glob pattern with * and ? wildcards to a LIKE pattern with \\ as escape character """
+    escaped = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%').replace('?', '_')
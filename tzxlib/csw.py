@@ -0,0 +1,92 @@
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy
+import zlib
+
+COMPRESSION_RLE  = 0x01
+COMPRESSION_ZRLE = 0x02
+
+def decodeCsw(data, compression, count=None):
+    """
+    Decodes compressed CSW data. Returns an int64 array of the pulse lengths,
+    in number of samples.
+    """
+    if compression == COMPRESSION_ZRLE:
+        try:
+            data = zlib.decompress(bytes(data))
+        except zlib.error as ex:
+            raise IOError('Bad Z-RLE compressed CSW data: {}'.format(ex))
+    elif compression != COMPRESSION_RLE:
+        raise IOError('Unknown CSW compression type {:02x}'.format(compression))
+    pulses = decodeRle(data)
+    if count is not None and len(pulses) > count:
+        pulses = pulses[0:count]
+    return pulses
+
+def decodeRle(data):
+    """
+    Decodes CSW RLE data. Each byte is a pulse length. A 0 byte is followed by
+    the pulse length as 32 bit little endian value.
+    """
+    raw = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+    lengths = raw.astype(numpy.int64)
+
+    # Find the escape bytes. A 0 byte inside of a long pulse value is no escape.
+    escapes = _findEscapes(numpy.flatnonzero(raw == 0))
+    if len(escapes) == 0:
+        return lengths
+
+    if escapes[-1] + 5 > len(raw):
+        # Ignore a truncated value at the end
+        raw = raw[0:escapes[-1]]
+        lengths = lengths[0:escapes[-1]]
+        escapes = escapes[:-1]
+
+    values = escapes[:, None] + numpy.arange(1, 5)
+    lengths[escapes] = raw[values].astype(numpy.int64) @ numpy.array([1, 1 << 8, 1 << 16, 1 << 24])
+    keep = numpy.ones(len(raw), dtype=bool)
+    keep[values.ravel()] = False
+    return lengths[keep]
+
+def _findEscapes(zeros):
+    """
+    Returns the positions of the escape bytes, given the positions of all 0
+    bytes. The first 0 byte is an escape, and each escape is followed by the
+    first 0 byte after its 32 bit value. All escapes are marked at once by
+    following that chain with pointer doubling.
+    """
+    zeros = numpy.asarray(zeros, dtype=numpy.int64)
+    count = len(zeros)
+    if count == 0:
+        return zeros
+
+    # Index of the next escape after each 0 byte, count is the end of the chain
+    jump = numpy.append(numpy.searchsorted(zeros, zeros + 5), count)
+    marked = numpy.zeros(count + 1, dtype=bool)
+    marked[0] = True
+
+    # After each step, all escapes up to 2 * steps links down the chain are marked
+    steps = 1
+    while steps <= count:
+        marked[jump[marked]] = True
+        jump = jump[jump]
+        steps *= 2
+    return zeros[marked[0:count]]
@@ -19,23 +19,33 @@
 #
 
 from collections import deque
-from struct import unpack
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import io
+import numpy
 import sys
-import wave
 
 from tzxlib.tapfile import TapFile, TapHeader, TapData
 from tzxlib.tzxblocks import TzxbData
 from tzxlib.tzxfile import TzxFile
+from tzxlib import trace as tr
+from tzxlib.wavfile import openWave, MappedWave
 
 def sgn(val):
     return 1 if val >= 0 else -1
 
-def unpackMono(data, size):
-    return unpack('<' + size, data)[0]
+def unpackMono(data, dtype):
+    return numpy.frombuffer(data, dtype=dtype).astype(numpy.int64)
 
-def unpackStereo(data, size, leftMix = 0.5):
-    val = unpack('<' + size + size, data)
-    return (val[0] * leftMix + val[1] * (1 - leftMix))
+def unpackStereo(data, dtype, leftMix = 0.5):
+    val = numpy.frombuffer(data, dtype=dtype).reshape(-1, 2)
+    return val[:, 0] * leftMix + val[:, 1] * (1 - leftMix)
+
+# Pulse types of the debug tags
+TRACE_PULSES = { '0': tr.BIT0, '1': tr.BIT1, '-': tr.SYNC, '~': tr.SYNC }
+
+def _loadSegment(loader, filename, startFrame, endFrame):
+    return list(loader.iterBlocks(filename, startFrame, endFrame))
 
 class TapeLoader():
 
@@ -46,55 +56,148 @@ class TapeLoader():
     lowT    =  855      # 0 bit pulse
     highT   = 1710      # 1 bit pulse
 
-    def __init__(self, progress=None, debug=None, verbose=False, treshold=3500, tolerance=1.2, leaderMin=20, cpufreq=3500000, leftChMix=0.5):
+    # Minimum length of a silent gap where a recording can be split
+    minGapMs = 200
+
+    def __init__(self, progress=None, debug=None, verbose=False, treshold=3500, tolerance=1.2, leaderMin=20, cpufreq=3500000, leftChMix=0.5, trace=None):
         maxlenT = self.leaderT * 2.2 * tolerance
         self.samples = TapeReader(progress=progress, cpufreq=cpufreq, maxlenT=maxlenT, leftChMix=leftChMix)
         self.debug = debug if debug is not None else 0
+        self.trace = trace
         self.verbose = verbose
         self.treshold = treshold
         self.tolerance = tolerance
         self.leaderMin = leaderMin
 
     def load(self, filename, startFrame=None, endFrame=None):
+        tzx = TzxFile()
+        for (tzxbd, startPos, endPos) in self.iterBlocks(filename, startFrame, endFrame):
+            tzx.blocks.append(tzxbd)
+        return tzx
+
+    def loadParallel(self, filename, jobs, startFrame=None, endFrame=None):
+        tzx = TzxFile()
+        for (tzxbd, startPos, endPos) in self.iterBlocksParallel(filename, jobs, startFrame, endFrame):
+            tzx.blocks.append(tzxbd)
+        return tzx
+
+    def iterBlocks(self, filename, startFrame=None, endFrame=None):
+        """
+        Loads the blocks one by one. Yields each block and its frame range as
+        soon as it was found.
+        """
+        try:
+            self.samples.open(filename)
+            if self.trace is not None:
+                self.trace.start(self.samples.framerate(), self.samples.cpufreq)
+            yield from self.iterRange(startFrame, endFrame)
+        finally:
+            self.samples.close()
+
+    def iterRange(self, startFrame=None, endFrame=None):
+        """
+        Loads the blocks in the given frame range of the WAV file that is
+        currently opened by the TapeReader. It can be used for decoding
+        arbitrary regions again, e.g. with other settings.
+        """
+        self.samples.fileRange(startFrame, endFrame)
+        while True:
+            try:
+                tzxbd = TzxbData()
+                (tzxData, startPos, endPos) = self._loadBlock()
+                tzxbd.setup(tzxData)
+            except BadBlock:
+                continue    # Try again with the next block
+            except EOFError:
+                break       # we're done!
+            if self.verbose:
+                self._showFound(tzxbd, startPos, endPos)
+            yield (tzxbd, startPos, endPos)
+
+    def iterBlocksParallel(self, filename, jobs, startFrame=None, endFrame=None):
+        """
+        Splits the recording at silent gaps, and loads the segments in parallel.
+        Yields each block and its frame range in order, as soon as its segment
+        was loaded. filename must be the name of a regular file, so every job
+        can open it.
+        """
+        segmentLoader = self._segmentLoader()
         try:
             self.samples.open(filename)
             self.samples.fileRange(startFrame, endFrame)
-            tzx = TzxFile()
-            while True:
-                try:
-                    tzxbd = TzxbData()
-                    (tzxData, startPos, endPos) = self._loadBlock()
-                    tzxbd.setup(tzxData)
-                    tzx.blocks.append(tzxbd)
-                    if self.verbose:
-                        startMillis = self.samples.toMilliSeconds(startPos)
-                        startSecs = startMillis // 1000
-                        startMins = startSecs // 60
-                        print(('{:3d}:{:02d}.{:03d} {:9d} - {:9d}: {}').format(
-                             startMins,
-                             startSecs % 60,
-                             startMillis % 1000,
-                             startPos,
-                             endPos,
-                             str(tzxbd)
-                        ), file=sys.stderr)
-                except BadBlock:
-                    continue    # Try again with the next block
-                except EOFError:
-                    break       # we're done!
+            first = startFrame if startFrame is not None else 0
+            last = min(endFrame, self.samples.frames()) if endFrame is not None else self.samples.frames()
+            minGap = self.samples.toFrames(self.samples.cpufreq * self.minGapMs / 1000)
+            gaps = self.samples.findGaps(minGap, self.treshold)
+
+            # Cut in the middle of the gaps, but avoid too small segments
+            minSize = (last - first) // (jobs * 4)
+            bounds = [first]
+            for (gapStart, gapEnd) in gaps:
+                cut = (gapStart + gapEnd) // 2
+                if cut - bounds[-1] >= minSize and last - cut >= minSize:
+                    bounds.append(cut)
+            bounds.append(last)
+
+            overlap = minGap // 4
+            segments = [(max(first, bounds[i] - overlap), min(last, bounds[i + 1] + overlap)) for i in range(len(bounds) - 1)]
+
+            found = None
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(_loadSegment, segmentLoader, filename, start, end) for (start, end) in segments]
+                for (future, (start, end)) in zip(futures, segments):
+                    for (tzxbd, startPos, endPos) in future.result():
+                        if found is not None and startPos <= found[2]:
+                            # Block was found twice in the overlap, keep the better one
+                            if self._isBetter(tzxbd, found[0]):
+                                found = (tzxbd, startPos, endPos)
+                            continue
+                        if found is not None:
+                            yield self._foundInParallel(*found)
+                        found = (tzxbd, startPos, endPos)
+                    if self.samples.progress is not None:
+                        self.samples.progress(end, self.samples.frames())
+            if found is not None:
+                yield self._foundInParallel(*found)
         finally:
             self.samples.close()
-        return tzx
+
+    def _foundInParallel(self, tzxbd, startPos, endPos):
+        if self.verbose:
+            self._showFound(tzxbd, startPos, endPos)
+        return (tzxbd, startPos, endPos)
+
+    def _segmentLoader(self):
+        """ Returns a silent copy of this loader, for loading a segment in another process """
+        loader = copy.copy(self)
+        loader.verbose = False
+        loader.trace = None
+        loader.samples = TapeReader(cpufreq=self.samples.cpufreq, maxlenT=self.samples.maxlenT, leftChMix=self.samples.leftChMix)
+        return loader
+
+    def _isBetter(self, block, other):
+        """ Checks if the block was read better than the other block """
+        if block.valid() != other.valid():
+            return block.valid()
+        return len(block.tap.data) > len(other.tap.data)
+
+    def _showFound(self, tzxbd, startPos, endPos):
+        startMillis = self.samples.toMilliSeconds(startPos)
+        startSecs = startMillis // 1000
+        startMins = startSecs // 60
+        print(('{:3d}:{:02d}.{:03d} {:9d} - {:9d}: {}').format(
+             startMins,
+             startSecs % 60,
+             startMillis % 1000,
+             startPos,
+             endPos,
+             str(tzxbd)
+        ), file=sys.stderr)
 
     def _loadBlock(self):
         tapCreator = TapCreator()
-        if self.debug >= 2:
-            tapCreator.callback = lambda val, crc, lng: \
-                    print('   > {:5d}: {:02x} {:c} CRC={:02x}'.format(
-                            lng,
-                            val,
-                            val if 0x20 <= val < 0x80 else 0x20,
-                            crc), file=sys.stderr)
+        if self.debug >= 2 or self.trace is not None:
+            tapCreator.callback = self._onByte
         self.samples.invert = False
 
         # Wait for leader
@@ -131,8 +234,7 @@ class TapeLoader():
         letMeGuess = False
 
         while True:
-            lowLen = self._testBitPulse(expectedLowT, '0')
-            highLen = self._testBitPulse(expectedHighT, '1')
+            (lowLen, highLen) = self._testBitPulses(expectedLowT, expectedHighT)
 
             # We detected a bit for sure?
             if lowLen is not None and lowLen[0]:
@@ -149,19 +251,19 @@ class TapeLoader():
 
             # We're not sure, but maybe we're lucky...
             if lowLen is not None and highLen is None:
-                self._advance(False, lowLen[1], tag='gap')
+                self._advance(False, lowLen[1], tag='gap', reason=tr.GUESSED_GAP)
                 tapCreator.shift(False)
                 continue
 
             if highLen is not None and lowLen is None:
-                self._advance(True, highLen[1], tag='gap')
+                self._advance(True, highLen[1], tag='gap', reason=tr.GUESSED_GAP)
                 tapCreator.shift(True)
                 continue
 
             # Hope for a broken Low bit, but not too often...
             if lowLen is not None and highLen is not None and letMeGuess:
                 letMeGuess = False
-                self._advance(False, lowLen[1], tag='noise')
+                self._advance(False, lowLen[1], tag='noise', reason=tr.GUESSED_NOISE)
                 tapCreator.shift(False)
                 continue
 
@@ -171,6 +273,8 @@ class TapeLoader():
             tap = tapCreator.createTap()
             if self.debug >= 1:
                 self._showBlock(tap, leaderPos, syncPos, self.samples.position())
+            if self.trace is not None:
+                self.trace.event(tr.BLOCK, leaderPos, length=len(tap.data), value=tap.valid())
             return (tap, leaderPos, self.samples.position())
 
     def _testLeaderPulse(self):
@@ -182,20 +286,23 @@ class TapeLoader():
         maxRange = self.samples.toFrames(self.leaderT * ( 1.1 * self.tolerance))
 
         # Find end of half pulse
-        startSign = sgn(self.samples[0])
-        count = 1
-        while sgn(self.samples[count]) == startSign:
-            count += 1
-            if count > maxRange:
-                return None
+        count = self.samples.signChange(maxRange)
+        if count is None:
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, self.lastPulse, pulse=tr.LEADER, reason=tr.NO_CROSSING)
+            return None
 
         if not (minRange <= count <= maxRange):
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, self.lastPulse, length=self.samples.toTStates(count), pulse=tr.LEADER, reason=tr.OUT_OF_RANGE)
             return None
 
         # Compute pulse duration in Z80 T-states
         length = self.samples.toTStates(count)
         if self.debug >= 3:
             print('   # {:5d} @{:n}~{:n}'.format(length, self.lastPulse, self.lastPulse + count), file=sys.stderr)
+        if self.trace is not None:
+            self.trace.event(tr.PULSE, self.lastPulse, length=length, pulse=tr.LEADER)
         self.samples.advance(count)
         return length
 
@@ -213,6 +320,8 @@ class TapeLoader():
                 print(' ! - below treshold, {} < {}'.format(
                         abs(maxv - minv),
                         self.treshold), file=sys.stderr)
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, self.lastPulse, pulse=tr.SYNC, reason=tr.BELOW_TRESHOLD, amplitude=abs(maxv - minv), bias=bias)
             return None
 
         # Find next zero crossing, normal signal
@@ -230,29 +339,41 @@ class TapeLoader():
 
         # Integrate both half waves
         countHalf = count // 2
-        w1 = sum([self.samples[i] for i in range(0, countHalf)]) / countHalf
-        w2 = sum([self.samples[i] for i in range(countHalf, count)]) / countHalf
+        w1 = self.samples.sum(0, countHalf) / countHalf
+        w2 = self.samples.sum(countHalf, count) / countHalf
 
         # Is it a full wave?
         if not (w1 < bias and w2 > bias and abs(w2 - w1) >= self.treshold / 2):
             if self.debug >= 4:
                 print(' ! {} not a full wave, w1={} w2={} bias={}'.format(tag, w1, w2, bias), file=sys.stderr)
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, self.lastPulse, length=self.samples.toTStates(count / 2), pulse=tr.SYNC,
+                        reason=tr.NOT_FULL_WAVE, amplitude=maxv - minv, bias=bias, value=self.samples.invert)
             return None
 
         # Success, this is a sync
         length = self.samples.toTStates(count / 2)
         if self.debug >= 3:
             print('   {} {:5d} @{:n}~{:n}'.format(tag, length, self.lastPulse, self.lastPulse + count), file=sys.stderr)
+        if self.trace is not None:
+            self.trace.event(tr.PULSE, self.lastPulse, length=length, pulse=tr.SYNC,
+                    amplitude=maxv - minv, bias=bias, value=self.samples.invert)
         self.samples.advance(count)
         return length
 
-    def _testBitPulse(self, tCycles, tag):
+    def _testBitPulses(self, lowT, highT):
         self.lastPulse = self.samples.position()
         self.samples.ensure()
 
-        # Convert to samples
-        frames = self.samples.toFrames(tCycles * 2)
-        (minv, maxv, bias) = self.samples.minMaxAvg(frames)
+        # Convert to samples, both bits share the same window statistics
+        lowFrames = self.samples.toFrames(lowT * 2)
+        highFrames = self.samples.toFrames(highT * 2)
+        (lowStats, highStats) = self.samples.minMaxAvgs(lowFrames, highFrames)
+
+        return (self._testBitPulse(lowFrames, '0', lowStats), self._testBitPulse(highFrames, '1', highStats))
+
+    def _testBitPulse(self, frames, tag, stats):
+        (minv, maxv, bias) = stats
 
         # Is amplitude above treshold?
         if abs(maxv - minv) < self.treshold:
@@ -261,6 +382,9 @@ class TapeLoader():
                         tag,
                         abs(maxv - minv),
                         self.treshold), file=sys.stderr)
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, self.lastPulse, pulse=TRACE_PULSES[tag], reason=tr.BELOW_TRESHOLD,
+                        amplitude=abs(maxv - minv), bias=bias)
             return None
 
         # Find next zero crossing
@@ -270,44 +394,68 @@ class TapeLoader():
 
         # Integrate both half waves
         countHalf = count // 2
-        w1 = sum([self.samples[i] for i in range(0, countHalf)]) / countHalf
-        w2 = sum([self.samples[i] for i in range(countHalf, count)]) / countHalf
+        w1 = self.samples.sum(0, countHalf) / countHalf
+        w2 = self.samples.sum(countHalf, count) / countHalf
 
         # Is it a full wave?
         if not (w1 < bias and w2 > bias and abs(w2 - w1) >= self.treshold):
             if self.debug >= 4:
                 print(' ! {} not a full wave, w1={} w2={} bias={}'.format(tag, w1, w2, bias), file=sys.stderr)
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, self.lastPulse, length=self.samples.toTStates(count / 2), pulse=TRACE_PULSES[tag],
+                        reason=tr.NOT_FULL_WAVE, amplitude=maxv - minv, bias=bias)
             return (False, count)
 
         # Success, this is a bit
         return (True, count)
 
-    def _advance(self, bit, count, tag=''):
+    def _advance(self, bit, count, tag='', reason=tr.NONE):
         self.samples.advance(count)
         if self.debug >= 3:
             length = self.samples.toTStates(count / 2)
             print('   {} {:5d} @{:n}~{:n} {}'.format(1 if bit else 0, length, self.lastPulse, self.lastPulse + count, tag), file=sys.stderr)
+        if self.trace is not None:
+            self.trace.event(tr.PULSE, self.lastPulse, length=self.samples.toTStates(count / 2),
+                    pulse=tr.BIT1 if bit else tr.BIT0, reason=reason, value=bit)
 
     def _findZeroCrossing(self, frames, bias, tag):
-        count = frames
         countL = int(frames / self.tolerance)
         countH = int(frames * self.tolerance)
 
-        while self.samples[count] <= bias:
-            count -= 1
-            if count < countL:
-                if self.debug >= 4:
-                    print(' ! {} no zero crossing detected, count={}, bias={}'.format(tag, count, bias), file=sys.stderr)
-                return None
+        # Search backwards for the last sample above bias
+        count = self.samples.lastAbove(bias, countL, min(frames, countH) + 1)
+        if count is None:
+            if self.debug >= 4:
+                print(' ! {} no zero crossing detected, count={}, bias={}'.format(tag, countL - 1, bias), file=sys.stderr)
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, self.samples.position(), pulse=TRACE_PULSES[tag], reason=tr.NO_CROSSING,
+                        bias=bias, value=tag == '~')
+            return None
 
-        while self.samples[count] > bias:
-            count += 1
-            if count > countH:
-                if self.debug >= 4:
-                    print(' ! {} no wave end in range, count={}, bias={}'.format(tag, count, bias), file=sys.stderr)
-                return None
+        # Search forward for the end of the wave
+        end = self.samples.firstNotAbove(bias, count + 1, countH + 1)
+        if end is None:
+            if self.debug >= 4:
+                print(' ! {} no wave end in range, count={}, bias={}'.format(tag, countH + 1, bias), file=sys.stderr)
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, self.samples.position(), pulse=TRACE_PULSES[tag], reason=tr.NO_WAVE_END,
+                        bias=bias, value=tag == '~')
+            return None
 
-        return count
+        return end
+
+    def _onByte(self, val, crc, lng):
+        if self.trace is not None:
+            self.trace.event(tr.BYTE, self.samples.position(), length=lng, value=val)
+        if self.debug >= 2:
+            self._showByte(val, crc, lng)
+
+    def _showByte(self, val, crc, lng):
+        print('   > {:5d}: {:02x} {:c} CRC={:02x}'.format(
+                lng,
+                val,
+                val if 0x20 <= val < 0x80 else 0x20,
+                crc), file=sys.stderr)
 
     def _showBlock(self, tap, leaderPos, syncPos, endPos):
         if isinstance(tap, TapHeader):
@@ -327,29 +475,187 @@ class TapeLoader():
 
 
 
+class PulseLoader(TapeLoader):
+    """
+    Decodes the tape from the half pulses that were found by a single
+    vectorized pass over the signal, instead of testing each sample. It is
+    much faster, but less robust against poor quality recordings.
+    """
+
+    # Maximum number of half pulses of a data block
+    maxPulses = 2 * 8 * 0x10000
+
+    def iterRange(self, startFrame=None, endFrame=None):
+        self.positions = None
+        yield from TapeLoader.iterRange(self, startFrame, endFrame)
+
+    def _readPulses(self):
+        window = self.samples.toFrames(self.leaderT * 16) | 1
+        self.positions = self.samples.readPulses(window, self.treshold / 4)
+        self.positions = numpy.append(self.positions, self.samples.position())  # end of signal
+        self.lengths = numpy.diff(self.positions) * self.samples.cpufreq / self.samples.framerate()
+
+        # Find all runs of leader pulses
+        minLen = self.leaderT / (1.3 * self.tolerance)
+        maxLen = self.leaderT * (1.1 * self.tolerance)
+        leader = numpy.concatenate(([False], (self.lengths >= minLen) & (self.lengths <= maxLen), [False]))
+        edges = numpy.flatnonzero(leader[1:] != leader[:-1])
+        starts = edges[0::2]
+        ends = edges[1::2]
+        longRuns = (ends - starts) >= max(self.leaderMin, 1)
+        self.leaderRuns = list(zip(starts[longRuns].tolist(), ends[longRuns].tolist()))
+        self.leaderRuns.reverse()
+        self.cursor = 0
+
+    def _loadBlock(self):
+        if self.positions is None:
+            self._readPulses()
+
+        # Skip leaders that were actually found inside the previous block
+        while self.leaderRuns and self.leaderRuns[-1][0] < self.cursor:
+            self.leaderRuns.pop()
+        if not self.leaderRuns:
+            raise EOFError()
+        (leaderIx, syncIx) = self.leaderRuns.pop()
+        self.cursor = syncIx
+
+        # Expected timings, relative to the measured leader
+        leaderLengths = self.lengths[max(leaderIx, syncIx - max(self.leaderMin, 20)):syncIx]
+        scale = leaderLengths.mean() / self.leaderT
+        if self.debug >= 3:
+            print('   # {:5d} x{:n} @{:n}~{:n}'.format(int(leaderLengths.mean()), syncIx - leaderIx,
+                    int(self.positions[leaderIx]), int(self.positions[syncIx])), file=sys.stderr)
+
+        # Sync is a single full wave
+        if syncIx + 2 > len(self.lengths):
+            raise EOFError()
+        syncLen = self.lengths[syncIx] + self.lengths[syncIx + 1]
+        expectedSyncT = 2 * scale * self.syncT
+        if self.trace is not None:
+            self.trace.events(tr.PULSE, self.positions[leaderIx:syncIx], self.lengths[leaderIx:syncIx], pulse=tr.LEADER)
+        if not (expectedSyncT / self.tolerance <= syncLen <= expectedSyncT * self.tolerance):
+            if self.debug >= 4:
+                print(' ! - no sync, length={:n}'.format(int(syncLen)), file=sys.stderr)
+            if self.trace is not None:
+                self.trace.event(tr.REJECT, int(self.positions[syncIx]), length=int(syncLen / 2), pulse=tr.SYNC, reason=tr.OUT_OF_RANGE)
+            raise BadBlock()
+        if self.trace is not None:
+            self.trace.event(tr.PULSE, int(self.positions[syncIx]), length=int(syncLen / 2), pulse=tr.SYNC)
+
+        # Each bit is a full wave, so evaluate the sum of each pair of half pulses
+        dataIx = syncIx + 2
+        count = min(len(self.lengths) - dataIx, self.maxPulses) // 2
+        firstHalf = self.lengths[dataIx:dataIx + count * 2:2]
+        secondHalf = self.lengths[dataIx + 1:dataIx + count * 2:2]
+        following = numpy.append(self.lengths[dataIx + 2:dataIx + count * 2 + 1:2], numpy.inf)[0:count]
+        expectedLowT = 2 * scale * self.lowT
+        expectedHighT = 2 * scale * self.highT
+
+        # The last half wave of a block fades into silence, and is only terminated
+        # by noise or the next signal on tape. Judge the last bit by its first half.
+        last = (secondHalf > expectedHighT * self.tolerance / 2) | (following > expectedHighT * self.tolerance)
+        secondHalf = numpy.where(last, firstHalf, secondHalf)
+        waves = firstHalf + secondHalf
+
+        valid = ((waves >= expectedLowT / self.tolerance) & (waves <= expectedLowT * self.tolerance)) \
+              | ((waves >= expectedHighT / self.tolerance) & (waves <= expectedHighT * self.tolerance))
+
+        # Both half waves must have about the same length
+        minHalf = waves / (2 * self.tolerance * self.tolerance)
+        valid &= (firstHalf >= minHalf) & (secondHalf >= minHalf)
+
+        # The block ends with the first invalid bit, or after the last bit
+        invalid = numpy.flatnonzero(~valid | numpy.concatenate(([False], last[:-1])))
+        bits = int(invalid[0]) if len(invalid) > 0 else count
+        endPos = int(self.positions[dataIx + bits * 2])
+        if bits > 0 and last[bits - 1]:
+            endPos = int(self.positions[dataIx + bits * 2 - 1]) + self.samples.toFrames(firstHalf[bits - 1])
+
+        if bits // 8 <= 2:
+            raise BadBlock()
+        self.cursor = dataIx + bits * 2
+
+        tapCreator = TapCreator()
+        if self.debug >= 2:
+            tapCreator.callback = self._showByte
+        bitValues = waves[0:bits // 8 * 8] > (expectedLowT + expectedHighT) / 2
+        tapCreator.extend(numpy.packbits(bitValues))
+        tap = tapCreator.createTap()
+
+        leaderPos = int(self.positions[leaderIx])
+        syncPos = int(self.positions[syncIx])
+        if self.debug >= 1:
+            self._showBlock(tap, leaderPos, syncPos, endPos)
+        if self.trace is not None:
+            bitPositions = self.positions[dataIx:dataIx + len(bitValues) * 2:2]
+            self.trace.events(tr.PULSE, bitPositions, waves[0:len(bitValues)] / 2,
+                    pulse=numpy.where(bitValues, tr.BIT1, tr.BIT0), values=bitValues)
+            self.trace.events(tr.BYTE, bitPositions[7::8], numpy.arange(1, len(tap.data) + 1),
+                    values=numpy.frombuffer(bytes(tap.data), dtype=numpy.uint8))
+            self.trace.event(tr.BLOCK, leaderPos, length=len(tap.data), value=tap.valid())
+        return (tap, leaderPos, endPos)
+
+
+
 class TapeReader():
+    readAheadMs = 4000      # size of a single read from the WAV file
+    progressMs = 100        # minimum distance between two progress reports
+
     def __init__(self, progress=None, cpufreq=3500000, maxlenT=6000, leftChMix=0.5):
         self.cpufreq = cpufreq
         self.progress = progress
         self.maxlenT = maxlenT
         self.invert = False
-        self.startFrame = None
         self.endFrame = None
         self.leftChMix = leftChMix
 
     def open(self, filename):
-        """ Opens the given WAV file name """
-        self.wav = wave.open(filename, 'r')
+        """ Opens the given WAV file name, memory-mapped if possible """
+        self.wav = openWave(filename)
+        self.seekable = isinstance(self.wav, MappedWave) or not isinstance(filename, io.IOBase) or filename.seekable()
         self.frameCount = 0
-        self.readFrame = self._createReader()
-        self.bytesPerFrame = self.wav.getnchannels() * self.wav.getsampwidth()
+        self.readFrames = self._createReader()
         self.maxlen = self.toFrames(self.maxlenT)
-        self.samples = deque(maxlen=self.maxlen)
+        self.readAhead = max(self.wav.getframerate() * self.readAheadMs // 1000, self.maxlen)
+        self.progressStep = max(self.wav.getframerate() * self.progressMs // 1000, 1)
+        self.nextProgress = 0
+        self.buffer = numpy.zeros(0, dtype=numpy.int64)
+        self.cursor = 0
+        self._clearStats()
 
     def fileRange(self, startFrame, endFrame):
-        self.startFrame = startFrame
+        """ Limits reading to the given frame range, and moves to the start frame """
+        self.seek(startFrame if startFrame is not None else 0)
         self.endFrame = endFrame
 
+    def seek(self, frame):
+        """
+        Moves to the given frame position. Seeking backwards is only possible if
+        the WAV file is seekable, or if the frame is still in the buffer.
+        """
+        frame = max(frame, 0)
+        if self.seekable:
+            frame = min(frame, self.wav.getnframes())
+        bufferStart = self.frameCount - self.cursor
+        bufferEnd = bufferStart + len(self.buffer)
+        if bufferStart <= frame <= bufferEnd:
+            self.cursor = frame - bufferStart
+        elif self.seekable:
+            self.wav.setpos(frame)
+            self._resetBuffer()
+        elif frame > bufferEnd:
+            skip = frame - bufferEnd
+            while skip > 0:
+                frames = self.wav.readframes(min(skip, 0x10000))
+                if not frames:
+                    break
+                skip -= len(frames) // (self.wav.getnchannels() * self.wav.getsampwidth())
+            self._resetBuffer()
+        else:
+            raise IOError('Cannot seek backwards in a stream')
+        self.frameCount = frame
+        self.nextProgress = frame
+
     def close(self):
         """ Closes the tape reader """
         if self.progress is not None:
@@ -358,69 +664,269 @@ class TapeReader():
 
     def __len__(self):
         """ Current length of sample buffer """
-        return len(self.samples)
+        return len(self.buffer) - self.cursor
 
     def __getitem__(self, ix):
         """ Gets the sample at given index """
-        return self.samples[ix] if not self.invert else -self.samples[ix]
+        val = self.buffer[self.cursor + ix]
+        return val if not self.invert else -val
+
+    def slice(self, start, end):
+        """ Gets an array of the samples in the given index range """
+        data = self.buffer[self.cursor + start:self.cursor + end]
+        return data if not self.invert else -data
 
     def position(self):
         """ Returns current frame position """
         return self.frameCount
 
     def ensure(self, needed=None):
-        """ Ensures buffer is filled with sufficient samples """
-        if self.startFrame is not None and self.frameCount < self.startFrame:
-            skip = self.startFrame - self.frameCount
-            self.frameCount = self.startFrame
-            self.startFrame = None
-            while skip > 0:
-                sf = skip if skip < 1000 else 1000
-                skip -= sf
-                frames = self.wav.readframes(sf)
-                if not frames:
-                    raise EOFError()
-
-        if needed is not None and len(self.samples) >= needed:
+        """ Ensures buffer is filled with sufficient samples, raises EOFError if there are not enough """
+        if needed is None:
+            needed = self.maxlen
+        available = len(self)
+        if available >= needed:
             return # sufficient data available
 
-        missing = self.samples.maxlen - len(self.samples)
-        if missing <= 0:
-            return # buffer is filled to maximum
-
-        frames = self.wav.readframes(missing)
-        if not frames:
+        chunks = [self.buffer[self.cursor:]]
+        while available < needed:
+            frames = self.wav.readframes(max(self.readAhead, needed - available))
+            if not frames:
+                break
+            chunks.append(self.readFrames(frames))
+            available += len(chunks[-1])
+
+        if len(chunks) > 1:
+            self.buffer = numpy.concatenate(chunks)
+            self.cursor = 0
+            self._clearStats()
+        if available < needed:
             raise EOFError()
 
-        for ix in range(0, len(frames), self.bytesPerFrame):
-            self.samples.append(self.readFrame(frames[ix:ix+self.bytesPerFrame]))
+    def _takeBuffer(self):
+        """ Returns the remaining buffered samples, and empties the buffer """
+        data = self.buffer[self.cursor:]
+        self._resetBuffer()
+        return data
+
+    def _resetBuffer(self):
+        """ Empties the buffer """
+        self.buffer = self.buffer[0:0]
+        self.cursor = 0
+        self._clearStats()
+
+    def findGaps(self, minFrames, treshold, chunkFrames=0x100000):
+        """
+        Reads the remaining signal and returns a list of (start, end) frame
+        ranges of at least minFrames length, where the peak-to-peak amplitude
+        stays below the treshold.
+        """
+        window = max(minFrames // 16, 1)
+        readFrames = max(chunkFrames // window, 1) * window
+        first = self.frameCount
+        pending = self._takeBuffer()
+        silent = []
+        while True:
+            count = readFrames
+            if self.endFrame is not None:
+                count = min(count, self.endFrame - self.frameCount)
+            frames = self.wav.readframes(count) if count > 0 else None
+            if not frames:
+                break
+            data = self.readFrames(frames)
+            if len(pending) > 0:
+                data = numpy.concatenate((pending, data))
+                pending = pending[0:0]
+            windows = data[0:len(data) // window * window].reshape(-1, window)
+            if len(windows) > 0:
+                silent.append((windows.max(axis=1) - windows.min(axis=1)) < treshold)
+            self.frameCount += len(data)
+
+        if not silent:
+            return []
+        silent = numpy.concatenate(([False], numpy.concatenate(silent), [False]))
+        edges = numpy.flatnonzero(silent[1:] != silent[:-1])
+        gaps = []
+        for (start, end) in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+            if (end - start) * window >= minFrames:
+                gaps.append((first + start * window, first + end * window))
+        return gaps
+
+    def readPulses(self, window, hysteresis, chunkFrames=0x100000):
+        """
+        Reads the remaining signal and returns an array of the frame positions of
+        all zero crossings. The signal is bias corrected by a moving average of
+        the given window size. Crossings are only detected when the level exceeds
+        the hysteresis, so noise around the zero line is ignored.
+        """
+        half = window // 2
+        data = self._takeBuffer()   # raw samples, including the look-behind
+        base = self.frameCount      # frame position of the first sample in data
+        level = 0                   # current signal level, 0 if still unknown
+        result = []
+        while True:
+            readFrames = chunkFrames
+            if self.endFrame is not None:
+                readFrames = min(readFrames, self.endFrame - base - len(data))
+            frames = self.wav.readframes(readFrames) if readFrames > 0 else None
+            if not frames:
+                break
+            data = numpy.concatenate((data, self.readFrames(frames)))
+            if len(data) <= window:
+                continue
+
+            # Bias corrected signal, for all samples with a complete window
+            csum = numpy.concatenate(([0], numpy.cumsum(data)))
+            bias = (csum[window:] - csum[:-window]) / window
+            signal = data[half:half + len(bias)] - bias
+
+            # Schmitt trigger: keep the previous level while inside the hysteresis
+            levels = numpy.where(signal >= hysteresis, 1, numpy.where(signal <= -hysteresis, -1, 0))
+            ix = numpy.where(levels != 0, numpy.arange(len(levels)), -1)
+            ix = numpy.maximum.accumulate(ix)
+            levels = numpy.where(ix >= 0, levels[ix], level)
+
+            changes = numpy.flatnonzero(numpy.concatenate(([level], levels[:-1])) != levels)
+            if level == 0 and len(changes) > 0:
+                changes = changes[1:]   # first level change is not a crossing
+            result.append(changes + base + half)
+            level = levels[-1]
+
+            # Keep the look-behind for the next chunk
+            consumed = len(bias)
+            data = data[consumed:]
+            base += consumed
+            self.frameCount = base
+            if self.progress is not None:
+                self.progress(self.frameCount, self.wav.getnframes())
+        return numpy.concatenate(result) if result else numpy.zeros(0, dtype=numpy.int64)
 
     def advance(self, frames):
         """ Advance number of frames """
         if frames == 0:
             return
         self.ensure(frames)
-        for i in range(0, frames):
-            self.samples.popleft()
+        self.cursor += frames
         self.frameCount += frames
         if self.endFrame is not None and self.frameCount > self.endFrame:
             raise EOFError()
-        if self.progress is not None:
+        if self.progress is not None and self.frameCount >= self.nextProgress:
             self.progress(self.frameCount, self.wav.getnframes())
+            self.nextProgress = self.frameCount + self.progressStep
 
     def minMaxAvg(self, frames):
         """ Returns a tuple of minimum, maximum and average of given range """
-        self.ensure(frames)
-        data = [self[i] for i in range(0, frames)]
-        return (min(data), max(data), sum(data) / frames)
+        return self.minMaxAvgs(frames)[0]
+
+    def minMaxAvgs(self, *frames):
+        """
+        Returns a list of minimum, maximum and average tuples of ranges of the
+        given lengths, all starting at the current position. The buffer is only
+        filled once, and all ranges are taken from the same window statistics.
+        """
+        self.ensure(max(frames))
+        result = []
+        for count in frames:
+            if count <= 0:
+                result.append((0, 0, 0))
+                continue
+            (minv, maxv) = self.minMax(0, count)
+            result.append((minv, maxv, self.sum(0, count) / count))
+        return result
+
+    def sum(self, start, end):
+        """ Returns the sum of the samples in the given index range """
+        if self.prefixSums is None:
+            self.prefixSums = numpy.concatenate(([0], numpy.cumsum(self.buffer)))
+        start = min(self.cursor + start, len(self.buffer))
+        end = min(self.cursor + end, len(self.buffer))
+        val = (self.prefixSums[end] - self.prefixSums[start]).item()
+        return val if not self.invert else -val
+
+    def minMax(self, start, end):
+        """ Returns a tuple of minimum and maximum of the samples in the given index range, or (0, 0) if it is empty """
+        if self.minTable is None:
+            self._buildMinMaxTables()
+        start = self.cursor + start
+        end = min(self.cursor + end, len(self.buffer))
+        if end <= start:
+            return (0, 0)
+        level = (end - start).bit_length() - 1
+        if level < len(self.minTable):
+            # Two overlapping power-of-two windows cover the range
+            other = end - (1 << level)
+            minv = min(self.minTable[level][start], self.minTable[level][other]).item()
+            maxv = max(self.maxTable[level][start], self.maxTable[level][other]).item()
+        else:
+            data = self.buffer[start:end]
+            (minv, maxv) = (data.min().item(), data.max().item())
+        return (minv, maxv) if not self.invert else (-maxv, -minv)
+
+    def _buildMinMaxTables(self):
+        """ Builds sparse tables of the minimum and maximum of power-of-two windows """
+        self.minTable = [self.buffer]
+        self.maxTable = [self.buffer]
+        size = 2
+        while size <= self.maxlen and size <= len(self.buffer):
+            half = size // 2
+            self.minTable.append(numpy.minimum(self.minTable[-1][:-half], self.minTable[-1][half:]))
+            self.maxTable.append(numpy.maximum(self.maxTable[-1][:-half], self.maxTable[-1][half:]))
+            size *= 2
+
+    def _clearStats(self):
+        """ Invalidates the window statistics of the buffer """
+        self.prefixSums = None
+        self.minTable = None
+        self.maxTable = None
 
     def nextRaisingEdge(self):
         """ Finds the next raising edge """
-        self.ensure(2)
-        while not (self[0] < 0 and self[1] >= 0):
-            self.advance(1)
+        window = 64
+        while True:
             self.ensure(2)
-        self.advance(1) # position on the first positive value
+            data = self.slice(0, window)
+            edges = numpy.flatnonzero((data[:-1] < 0) & (data[1:] >= 0))
+            if len(edges) > 0:
+                self.advance(int(edges[0]) + 1) # position on the first positive value
+                return
+            self.advance(len(data) - 1)
+            window = min(window * 2, self.readAhead)
+
+    def signChange(self, maxCount):
+        """
+        Returns the index of the first sample whose sign differs from the
+        current sample, or None if there is none up to index maxCount
+        """
+        data = self.slice(0, maxCount + 1).tolist()
+        positive = data[0] >= 0
+        for ix in range(1, len(data)):
+            if (data[ix] >= 0) != positive:
+                return ix
+        return None
+
+    def lastAbove(self, level, start, end):
+        """ Returns the index of the last sample above level in the given index range, or None """
+        data = self.slice(start, end).tolist()
+        for ix in range(len(data) - 1, -1, -1):
+            if data[ix] > level:
+                return start + ix
+        return None
+
+    def firstNotAbove(self, level, start, end):
+        """ Returns the index of the first sample not above level in the given index range, or None """
+        data = self.slice(start, end).tolist()
+        for ix in range(len(data)):
+            if not data[ix] > level:
+                return start + ix
+        return None
+
+    def frames(self):
+        """ Returns the number of frames of the WAV file """
+        return self.wav.getnframes()
+
+    def framerate(self):
+        """ Returns the frame rate of the WAV file """
+        return self.wav.getframerate()
 
     def toTStates(self, frames):
         """ Converts number of frames to T-States """
@@ -435,16 +941,17 @@ class TapeReader():
         return int(tCycles * self.wav.getframerate() / self.cpufreq)
 
     def _createReader(self):
-        """ Returns a function that converts frame byte array to sample data """
+        """ Returns a function that converts a frame byte array to an array of sample data """
         channels = self.wav.getnchannels()
         bpc = self.wav.getsampwidth()
         if bpc == 2:
-            if channels == 2:   return lambda f: unpackStereo(f, 'h', self.leftChMix)
-            elif channels == 1: return lambda f: unpackMono(f, 'h')
+            if channels == 2:   return lambda f: unpackStereo(f, '<i2', self.leftChMix)
+            elif channels == 1: return lambda f: unpackMono(f, '<i2')
             else:               raise IOError('Cannot handle WAV files with {} channels'.format(channels))
         elif bpc == 1:
-            if channels == 2:   return lambda f: unpackStereo(f, 'b', self.leftChMix) * 256
-            elif channels == 1: return lambda f: unpackMono(f, 'b') * 256
+            # 8 bit samples are unsigned
+            if channels == 2:   return lambda f: (unpackStereo(f, 'u1', self.leftChMix) - 128) * 256
+            elif channels == 1: return lambda f: (unpackMono(f, 'u1') - 128) * 256
             else:               raise IOError('Cannot handle WAV files with {} channels'.format(channels))
         else:
             raise IOError('Cannot handle WAV files with {} bits per channel'.format(bpc * 8))
@@ -473,6 +980,14 @@ class TapCreator():
             self.shifter = 0
             self.bits = 0
 
+    def extend(self, data):
+        """ Shifts in all bytes of the given data """
+        for val in data:
+            self.crc ^= val
+            self.data.append(val)
+            if self.callback is not None:
+                self.callback(val, self.crc, len(self.data))
+
     def __len__(self):
         """ Current length of collected data, in bytes """
         return len(self.data)
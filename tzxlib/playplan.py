@@ -0,0 +1,181 @@
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from bisect import bisect_right
+import copy
+
+from tzxlib.saver import TapeSaver
+from tzxlib.tzxblocks import TzxbLoopStart, TzxbLoopEnd, TzxbJumpTo, TzxbCallSequence, TzxbReturn
+from tzxlib.tzxblocks import TzxbPause, TzxbStopTape48k
+from tzxlib.tzxfile import TzxFile
+
+class PlanEntry():
+    """
+    A block in the order of playback, with its start time, duration and start
+    signal level. If the plan was compiled with a sample based saver, the exact
+    start position of the saver and the start sample are also given. The
+    duration is None if the block cannot be played back.
+    """
+
+    def __init__(self, index, block, repetition, startNs, startState, play=True, note=None):
+        self.index = index
+        self.block = block
+        self.repetition = repetition
+        self.startNs = startNs
+        self.durationNs = 0
+        self.startState = startState
+        self.startTicks = None
+        self.startSample = None
+        self.play = play
+        self.note = note
+
+
+class PlaybackPlan():
+    """
+    The linear playback order of a TZX file. Loops, jumps and call sequences are
+    resolved, and the start time and signal level of each played block is
+    computed without generating its pulses, so playback can be started at any
+    block or time. If a saver is given, the times are computed with a copy of it.
+
+    If a block cannot be played back, the plan ends with its entry, and error
+    is set to the reason. Rendering that entry will then fail.
+    """
+
+    def __init__(self, tzx:TzxFile, cpufreq=3500000, stopAlways=False, stop48k=False, saver:TapeSaver=None):
+        self.cpufreq = cpufreq
+        self.entries = []
+        self.durationNs = 0
+        self.endSample = None
+        self.error = None
+        self._compile(tzx, stopAlways, stop48k, copy.copy(saver) if saver is not None else TapeSaver(cpufreq))
+        self.starts = [e.startNs for e in self.entries]
+
+    def findBlock(self, index):
+        """ Returns the position of the first entry playing the given block index """
+        for (pos, entry) in enumerate(self.entries):
+            if entry.index == index:
+                return pos
+        raise IndexError('Block %d is not played back' % (index))
+
+    def findTime(self, ns):
+        """ Returns the position of the entry that is played at the given time """
+        pos = bisect_right(self.starts, ns) - 1
+        if pos < 0 or ns >= self.durationNs:
+            raise IndexError('Time is beyond the end of the recording')
+        return pos
+
+    def _compile(self, tzx, stopAlways, stop48k, saver):
+        block = 0
+        repeatBlock = None
+        repeatCount = None
+        repetition = 0
+        callBlock = None
+        callIndex = None
+        visited = set()
+
+        while block < len(tzx.blocks):
+            b = tzx.blocks[block]
+            entry = PlanEntry(block, b, repetition, self.durationNs, saver.currentState, play=False)
+            if saver.rate is not None:
+                entry.startTicks = saver.ticks
+                entry.startSample = saver.sample()
+            self.entries.append(entry)
+            block += 1
+
+            if isinstance(b, TzxbLoopStart):
+                repeatBlock = block
+                repeatCount = b.repeats()
+                repetition = 0
+            elif isinstance(b, TzxbLoopEnd) and repeatBlock is not None:
+                repeatCount -= 1
+                if repeatCount > 0:
+                    block = repeatBlock
+                    repetition += 1
+                    entry.note = 'returning to block %d (remaining %d)' % (block, repeatCount)
+                else:
+                    repeatBlock = None
+                    repeatCount = None
+                    repetition = 0
+                    entry.note = 'loop is finished'
+            elif isinstance(b, TzxbJumpTo):
+                block += b.relative() - 1
+                if block < 0 or block > len(tzx.blocks) - 1:
+                    raise IndexError('Jump to non-existing block')
+                entry.note = 'jumping to block %d' % (block)
+            elif isinstance(b, TzxbCallSequence) and callBlock is None:
+                calls = b.calls()
+                if calls:
+                    callBlock = block - 1
+                    callIndex = 0
+                    block = self._callTarget(tzx, callBlock, calls[0])
+                    entry.note = 'calling block %d' % (block)
+            elif isinstance(b, TzxbReturn) and callBlock is not None:
+                calls = tzx.blocks[callBlock].calls()
+                callIndex += 1
+                if callIndex < len(calls):
+                    block = self._callTarget(tzx, callBlock, calls[callIndex])
+                    entry.note = 'calling block %d' % (block)
+                else:
+                    block = callBlock + 1
+                    callBlock = None
+                    callIndex = None
+                    entry.note = 'returning to block %d' % (block)
+            elif isinstance(b, TzxbPause) and b.stopTheTape() and stopAlways:
+                entry.note = 'tape stopped'
+                break
+            elif isinstance(b, TzxbStopTape48k) and stop48k:
+                entry.note = 'tape stopped (48k mode)'
+                break
+            else:
+                entry.play = True
+                try:
+                    duration = b.duration(saver)
+                except (NotImplementedError, IOError) as ex:
+                    # The position after this block is unknown, so the plan ends here
+                    entry.durationNs = None
+                    entry.note = 'cannot be played back: %s' % (ex)
+                    self.error = ex
+                    saver.currentState = entry.startState
+                    if saver.rate is not None:
+                        saver.ticks = entry.startTicks
+                    break
+                if saver.rate is not None:
+                    # Sample based durations are derived from the exact position
+                    duration = saver.ticks * 1000000000 // (saver.cpufreq * saver.rate) - self.durationNs
+                entry.durationNs = duration
+                self.durationNs += duration
+                continue
+
+            # A control flow state that was seen before would loop endlessly
+            state = (block, repeatBlock, repeatCount, callBlock, callIndex)
+            if isinstance(b, (TzxbJumpTo, TzxbCallSequence)):
+                if state in visited:
+                    entry.note = 'endless loop, playback stopped'
+                    break
+                visited.add(state)
+
+        if saver.rate is not None:
+            self.endSample = saver.sample()
+
+    def _callTarget(self, tzx, callBlock, offset):
+        target = callBlock + offset
+        if target < 0 or target > len(tzx.blocks) - 1:
+            raise IndexError('Call to non-existing block')
+        return target
@@ -18,85 +18,285 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from tzxlib.tapfile import TapFile
+import numpy
 
-BYTE_ORDER = [0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01]
+from tzxlib.tapfile import TapFile
 
 class TapeSaver():
-    def __init__(self, cpufreq=3500000):
+    """
+    Generates the pulses of a tape signal. All methods return a NumPy int64
+    array of pulse lengths, in ns. Each pulse toggles the signal level, so a
+    pulse of length 0 just toggles the level.
+
+    If a sample rate is given, the pulse lengths are returned in samples
+    instead. The position is then kept in an exact accumulator of T-states
+    multiplied by the sample rate, so the pulse lengths do not drift.
+
+    While duration() measures a block, all methods return the total length of
+    the pulses instead, without generating them.
+    """
+
+    variant = ''    # identifies savers that generate different pulses for the same block
+
+    def __init__(self, cpufreq=3500000, rate=None):
         self.cpufreq = cpufreq
+        self.rate = rate
+        self.ticks = 0  # position in 1/cpufreq samples, only if rate is set
         self.currentState = False
+        self.measuring = False
+
+    def pulsesFor(self, block):
+        """
+        Returns all pulses of the playback of the given TZX block, and the
+        signal level of each pulse. As each pulse toggles the level, the first
+        pulse has the opposite level of currentState before the block.
+        """
+        startState = self.currentState
+        pulses = list(block.playback(self))
+        pulses = numpy.concatenate(pulses) if pulses else numpy.zeros(0, dtype=numpy.int64)
+        levels = (numpy.arange(len(pulses)) % 2 == 0) != startState
+        return (pulses, levels)
+
+    def duration(self, block):
+        """ Returns the playing time of the given TZX block, and updates the state like its playback """
+        self.measuring = True
+        try:
+            return sum(int(length) for length in block.playback(self))
+        finally:
+            self.measuring = False
+
+    def sample(self, ticks=None):
+        """ Returns the sample position of the given or current position """
+        return ((self.ticks if ticks is None else ticks) + self.cpufreq // 2) // self.cpufreq
 
     def pulse(self, length):
-        self.currentState = not self.currentState
-        yield self.tStatesToNs(length)
+        return self.pulses([length])
+
+    def pulses(self, lengths):
+        return self._emit(numpy.asarray(lengths, dtype=numpy.int64))
+
+    def samplePulses(self, lengths, sampleRate):
+        """ Returns the pulses of lengths given in number of samples """
+        return self._emit(numpy.asarray(lengths, dtype=numpy.int64), sampleRate=sampleRate)
+
+    def symbols(self, flags, pulses, sequence):
+        """
+        Returns the pulses of a sequence of symbols. flags and pulses are the
+        polarity flags and the pulse lengths of each symbol. A pulse of length 0
+        terminates the symbol.
+        """
+        (pulses, counts, sequence, extra) = self._resolveSymbols(flags, pulses, sequence)
+
+        # Each symbol has a variant with and without a leading empty pulse
+        variants = []
+        for symbol in range(len(pulses)):
+            lengths = pulses[symbol, 0:counts[symbol]]
+            variants.append(lengths)
+            variants.append(numpy.concatenate(([0], lengths)) if len(lengths) > 0 else lengths)
+        sizes = numpy.array([len(v) for v in variants])
+        offsets = numpy.cumsum(sizes) - sizes
+        table = numpy.concatenate(variants) if variants else numpy.zeros(0, dtype=numpy.int64)
+
+        keys = sequence * 2 + extra
+        lengths = sizes[keys]
+        starts = numpy.cumsum(lengths) - lengths
+        index = numpy.repeat(offsets[keys] - starts, lengths) + numpy.arange(int(lengths.sum()))
+        return self._emit(table[index].astype(numpy.int64))
 
     def tone(self, length, number):
-        lstates = self.tStatesToNs(length)
-        for _ in range(number // 2):
-            yield lstates
-            yield lstates
-        if number % 2 == 1:
-            self.currentState = not self.currentState
-            yield lstates
+        return self._emit(numpy.array([length], dtype=numpy.int64), [number])
 
     def saveTapFile(self, tap, pilotPulse=2168, syncHiPulse=667, syncLoPulse=735,
                     zeroPulse=855, onePulse=1710, leaderTone=None, finalBits=8):
+        lengths = []
+        counts = []
+
         # Generate leader tone
         if pilotPulse is not None:
-            lpulse = self.tStatesToNs(pilotPulse)
-            for _ in range(leaderTone if leaderTone is not None else tap.leaderCycles() // 2):
-                yield lpulse
-                yield lpulse
+            count = leaderTone if leaderTone is not None else tap.leaderCycles() // 2
+            lengths.append(pilotPulse)
+            counts.append(count * 2)
 
         # Generate sync pulse
-        if syncHiPulse is not None:
-            yield self.tStatesToNs(syncHiPulse)
-        if syncLoPulse is not None:
-            yield self.tStatesToNs(syncLoPulse)
-
-        # Send all bits
-        counter = finalBits
-        lone = self.tStatesToNs(onePulse)
-        lzero = self.tStatesToNs(zeroPulse)
-        for i in range(len(tap.data)):
-            b = tap.data[i]
-            for m in BYTE_ORDER:
-                if b & m != 0:
-                    yield lone
-                    yield lone
-                else:
-                    yield lzero
-                    yield lzero
-                if i == len(tap.data)-1:
-                    counter -= 1
-                    if counter <= 0:
-                        break
+        for sync in (syncHiPulse, syncLoPulse):
+            if sync is not None:
+                lengths.append(sync)
+                counts.append(1)
+
+        # Send all bits, each bit is a full wave
+        bits = self._bits(tap.data, finalBits)
+        lengths = numpy.concatenate((numpy.array(lengths, dtype=numpy.int64), numpy.where(bits, onePulse, zeroPulse)))
+        counts = numpy.concatenate((numpy.array(counts, dtype=numpy.int64), numpy.full(len(bits), 2)))
+        return self._emit(lengths.astype(numpy.int64), counts)
 
     def saveDirect(self, data, finalBits, tstates):
-        if len(data) == 0:
-            return
-        counter = finalBits
-        lstate = self.tStatesToNs(tstates)
-        for i in range(len(data)):
-            b = data[i]
-            for m in BYTE_ORDER:
-                newState = b & m != 0
-                if newState == self.currentState:
-                    yield 0
-                yield lstate
-                self.currentState = newState
-                if i == len(data)-1:
-                    counter -= 1
-                    if counter <= 0:
-                        break
+        bits = self._bits(data, finalBits).astype(bool)
+
+        # Insert an empty pulse if the level does not change
+        same = bits == numpy.concatenate(([self.currentState], bits[:-1]))
+        counts = same + 1
+        result = numpy.full(int(counts.sum()), tstates, dtype=numpy.int64)
+        result[(numpy.cumsum(counts) - counts)[same]] = 0
+        return self._emit(result)
 
     def pause(self, milliseconds):
-        if milliseconds > 0:
-            if not self.currentState:
-                yield 0
-            self.currentState = False
-            yield milliseconds * 1000000
+        if milliseconds <= 0:
+            return self._emit(numpy.zeros(0, dtype=numpy.int64))
+        result = [self._pauseLength(milliseconds)] if self.currentState else [0, self._pauseLength(milliseconds)]
+        if self.rate is None:
+            # The pause is given in ns, which is a sample rate of 1 GHz
+            return self._emit(numpy.array(result, dtype=numpy.int64), sampleRate=1000000000)
+        return self._emit(numpy.array(result, dtype=numpy.int64))
 
     def tStatesToNs(self, tstates):
         return tstates * 1000000000 // self.cpufreq
+
+    def _emit(self, lengths, counts=None, sampleRate=None):
+        """
+        Returns the pulses of the given lengths, each repeated counts times.
+        The lengths are given in T-states, or in samples of sampleRate. Each
+        pulse toggles the signal level. If a block is measured, only the total
+        length of the pulses is returned.
+        """
+        number = len(lengths) if counts is None else int(numpy.sum(counts))
+        if number % 2 == 1:
+            self.currentState = not self.currentState
+
+        if self.measuring:
+            if sampleRate is not None:
+                return self._sampleDuration(int(numpy.sum(lengths)), sampleRate)
+            return self._duration(lengths, 1 if counts is None else counts)
+
+        if counts is not None:
+            lengths = numpy.repeat(lengths, counts)
+        if sampleRate is not None:
+            return self._convertSamples(lengths, sampleRate)
+        return self._convert(lengths)
+
+    def _convert(self, tstates):
+        """ Converts an array of pulse lengths in T-states to the output unit """
+        if self.rate is None:
+            return self.tStatesToNs(tstates)
+        return self._advance(self.ticks + numpy.cumsum(tstates * self.rate))
+
+    def _advance(self, ends):
+        """ Returns the lengths in samples of pulses ending at the given ticks, and moves to the last one """
+        if len(ends) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        lengths = numpy.diff(self.sample(ends), prepend=self.sample())
+        self.ticks = int(ends[-1])
+        return lengths
+
+    def _convertSamples(self, lengths, sampleRate):
+        """ Converts an array of pulse lengths in samples of another sample rate to the output unit """
+        if self.rate is None:
+            ends = numpy.cumsum(lengths) * 1000000000 // sampleRate
+            return numpy.diff(ends, prepend=0)
+        ends = self.ticks + self._sampleTicks(numpy.cumsum(lengths, dtype=numpy.int64), sampleRate)
+        return self._advance(ends)
+
+    def _duration(self, tstates, counts):
+        """ Returns the total length of pulses given in T-states, each used counts times """
+        tstates = numpy.asarray(tstates, dtype=numpy.int64)
+        if self.rate is None:
+            return int((self.tStatesToNs(tstates) * counts).sum())
+        start = self.sample()
+        self.ticks += int((tstates * counts).sum()) * self.rate
+        return self.sample() - start
+
+    def _sampleDuration(self, samples, sampleRate):
+        """ Returns the total length of pulses given in number of samples of another sample rate """
+        if self.rate is None:
+            return samples * 1000000000 // sampleRate
+        start = self.sample()
+        self.ticks += int(self._sampleTicks(samples, sampleRate))
+        return self.sample() - start
+
+    def _pauseLength(self, milliseconds):
+        """ Returns the length of a pause, in ns, or in T-states if a sample rate is set """
+        if self.rate is None:
+            return milliseconds * 1000000
+        return milliseconds * self.cpufreq // 1000
+
+    def _sampleTicks(self, samples, sampleRate):
+        """ Converts a number of samples of another sample rate to ticks """
+        factor = self.cpufreq * self.rate
+        return samples // sampleRate * factor + samples % sampleRate * factor // sampleRate
+
+    def _resolveSymbols(self, flags, pulses, sequence):
+        """
+        Resolves the signal levels of a sequence of symbols. Returns the pulse
+        table, the number of pulses of each symbol, the sequence, and whether a
+        symbol needs a leading empty pulse for getting the required level.
+        """
+        # Number of pulses and polarity of each symbol in the sequence
+        pulses = numpy.asarray(pulses, dtype=numpy.int64)
+        sequence = numpy.asarray(sequence, dtype=numpy.int64)
+        if len(sequence) > 0 and sequence.max() >= len(pulses):
+            raise IOError('Undefined symbol {}'.format(sequence.max()))
+        counts = numpy.argmin(numpy.concatenate((pulses, numpy.zeros((len(pulses), 1), dtype=numpy.int64)), axis=1) > 0, axis=1)
+        polarity = numpy.where(counts > 0, flags & 0x03, 0)
+        n = counts[sequence]
+        pol = polarity[sequence]
+
+        # Level after each symbol. A symbol of forced level resets the level,
+        # otherwise the level is toggled by each pulse. Polarity 1 keeps the
+        # level, so it starts with an extra empty pulse.
+        forced = pol >= 2
+        toggles = numpy.where(forced, 0, (n + (pol == 1)) % 2)
+        parity = numpy.cumsum(toggles) % 2
+        forcedIx = numpy.maximum.accumulate(numpy.where(forced, numpy.arange(len(sequence)), -1))
+        forcedEnd = (pol == 3) ^ ((n - 1) % 2 == 1)
+        start = numpy.where(forcedIx >= 0, forcedEnd[forcedIx] ^ (parity[forcedIx] == 1), self.currentState)
+        levels = start ^ (parity == 1)
+        previous = numpy.concatenate(([self.currentState], levels[:-1]))
+        extra = numpy.where(forced, previous == (pol == 3), pol == 1)
+        return (pulses, counts, sequence, extra)
+
+    def _bits(self, data, finalBits):
+        """ Returns the bits of the data, MSB first, only finalBits of the last byte """
+        bits = numpy.unpackbits(numpy.frombuffer(bytes(data), dtype=numpy.uint8))
+        if len(bits) > 0:
+            bits = bits[0:len(bits) - 8 + min(max(finalBits, 1), 8)]
+        return bits
+
+
+class FastLoadSaver(TapeSaver):
+    """
+    A TapeSaver for loading real hardware faster. Leader tones are shortened to
+    what the ROM loader still detects, and long pauses are clamped. Optionally,
+    the bits of blocks with standard timing are shortened as far as the ROM
+    loader still tells them apart.
+    """
+
+    # The ROM loader waits for 1 s after the first leader edge, and then needs
+    # another 256 leader cycles.
+    LEADER_CYCLES = 1300
+    MAX_PAUSE = 500         # ms
+
+    # The ROM loader reads a bit as 1 if both pulses take more than about
+    # 2200 T-states in total.
+    ZERO_PULSE = 600
+    ONE_PULSE = 1300
+
+    def __init__(self, cpufreq=3500000, fastBits=False, rate=None):
+        super().__init__(cpufreq, rate)
+        self.fastBits = fastBits
+        self.variant = 'fast-bits' if fastBits else 'fast'
+
+    def saveTapFile(self, tap, pilotPulse=2168, syncHiPulse=667, syncLoPulse=735,
+                    zeroPulse=855, onePulse=1710, leaderTone=None, finalBits=8):
+        (zeroPulse, onePulse, leaderTone) = self._fastTiming(tap, pilotPulse, zeroPulse, onePulse, leaderTone)
+        return super().saveTapFile(tap, pilotPulse, syncHiPulse, syncLoPulse, zeroPulse, onePulse, leaderTone, finalBits)
+
+    def pause(self, milliseconds):
+        return super().pause(min(milliseconds, self.MAX_PAUSE))
+
+    def _fastTiming(self, tap, pilotPulse, zeroPulse, onePulse, leaderTone):
+        """ Returns the zero and one pulse lengths and the leader tone length to be used """
+        if pilotPulse is not None:
+            count = leaderTone if leaderTone is not None else tap.leaderCycles() // 2
+            leaderTone = min(count, self.LEADER_CYCLES)
+        if self.fastBits and zeroPulse == 855 and onePulse == 1710:
+            (zeroPulse, onePulse) = (self.ZERO_PULSE, self.ONE_PULSE)
+        return (zeroPulse, onePulse, leaderTone)
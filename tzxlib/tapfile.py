@@ -19,24 +19,22 @@
 #
 
 from struct import pack, unpack
+import numpy
 
 from tzxlib.convert import convert
 
 class TapFile():
     def create(data):
         if len(data) == 19 and data[0] == 0x00:
-            return TapHeader(data)
+            return TapHeader(bytes(data))
         else:
             return TapData(data)
 
     def valid(self):
-        val = 0;
-        for b in self.data:
-            val ^= b
-        return val == 0
+        return bool(numpy.bitwise_xor.reduce(numpy.frombuffer(self.data, dtype=numpy.uint8)) == 0)
 
     def body(self):
-        return self.data[1:-1]
+        return memoryview(self.data)[1:-1]
 
     def leaderCycles(self):
         return 3223
@@ -0,0 +1,132 @@
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from struct import pack, unpack
+import numpy
+
+TRACE_MAGIC = b'TZXTRACE'
+TRACE_VERSION = 1
+
+# Events
+PULSE  = 1      # pulse was accepted
+REJECT = 2      # pulse was rejected
+BYTE   = 3      # byte was completed, value is the byte
+BLOCK  = 4      # block was completed, length is the number of bytes, value is 1 if CRC is valid
+
+# Pulse types
+LEADER = 1
+SYNC   = 2
+BIT0   = 3
+BIT1   = 4
+
+# Reasons
+NONE           = 0
+OUT_OF_RANGE   = 1      # pulse length out of range
+BELOW_TRESHOLD = 2      # amplitude below treshold
+NOT_FULL_WAVE  = 3      # half waves do not form a full wave
+NO_CROSSING    = 4      # no zero crossing detected
+NO_WAVE_END    = 5      # no end of wave in range
+GUESSED_GAP    = 6      # bit accepted, because the other bit was not detected at all
+GUESSED_NOISE  = 7      # bit accepted, assuming a noisy 0 bit
+
+EVENT_NAMES  = { PULSE: 'pulse', REJECT: 'reject', BYTE: 'byte', BLOCK: 'block' }
+PULSE_NAMES  = { 0: '-', LEADER: 'leader', SYNC: 'sync', BIT0: 'bit0', BIT1: 'bit1' }
+REASON_NAMES = {
+    NONE: '-',
+    OUT_OF_RANGE: 'out of range',
+    BELOW_TRESHOLD: 'below treshold',
+    NOT_FULL_WAVE: 'not a full wave',
+    NO_CROSSING: 'no zero crossing',
+    NO_WAVE_END: 'no wave end',
+    GUESSED_GAP: 'guessed, gap',
+    GUESSED_NOISE: 'guessed, noise',
+}
+
+TRACE_DTYPE = numpy.dtype([
+    ('position',  '<i8'),   # frame position in the WAV file
+    ('length',    '<i4'),   # pulse length in T-states, or number of bytes
+    ('amplitude', '<i4'),   # peak-to-peak amplitude of the tested window
+    ('bias',      '<f4'),   # bias of the tested window
+    ('event',     'u1'),
+    ('pulse',     'u1'),
+    ('reason',    'u1'),
+    ('value',     'u1'),    # bit or byte value, 1 for inverted sync pulses
+])
+
+
+class TraceWriter():
+    """
+    Records loader events into a compact binary trace file. Events are collected
+    in a NumPy structured array, and written to the file when it is full.
+    """
+
+    def __init__(self, output, bufferSize=0x10000):
+        self.output = output
+        self.buffer = numpy.zeros(bufferSize, dtype=TRACE_DTYPE)
+        self.count = 0
+
+    def start(self, framerate, cpufreq):
+        """ Writes the trace header, must be invoked before the first event """
+        self.output.write(pack('<8sHLL', TRACE_MAGIC, TRACE_VERSION, framerate, cpufreq))
+
+    def event(self, event, position, length=0, pulse=0, reason=NONE, amplitude=0, bias=0.0, value=0):
+        """ Records a single event """
+        self.buffer[self.count] = (position, length, amplitude, bias, event, pulse, reason, value)
+        self.count += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def events(self, event, positions, lengths, pulse=0, values=0):
+        """ Records events of the same kind, given as arrays of positions and lengths """
+        self.flush()
+        records = numpy.zeros(len(positions), dtype=TRACE_DTYPE)
+        records['position'] = positions
+        records['length'] = lengths
+        records['event'] = event
+        records['pulse'] = pulse
+        records['value'] = values
+        self.output.write(records.tobytes())
+
+    def flush(self):
+        """ Writes all pending events to the trace file """
+        if self.count > 0:
+            self.output.write(self.buffer[0:self.count].tobytes())
+            self.count = 0
+        self.output.flush()
+
+    def close(self):
+        """ Writes all pending events, and closes the trace file """
+        self.flush()
+        self.output.close()
+
+
+def readTrace(input):
+    """ Reads a trace file, returns a tuple of framerate, cpufreq and the array of events """
+    data = input.read()
+    headerLen = 18
+    if len(data) < headerLen:
+        raise IOError('Not a trace file')
+    (magic, version, framerate, cpufreq) = unpack('<8sHLL', data[0:headerLen])
+    if magic != TRACE_MAGIC:
+        raise IOError('Not a trace file')
+    if version != TRACE_VERSION:
+        raise IOError('Unsupported trace file version {}'.format(version))
+    count = (len(data) - headerLen) // TRACE_DTYPE.itemsize
+    return (framerate, cpufreq, numpy.frombuffer(data, dtype=TRACE_DTYPE, count=count, offset=headerLen))
@@ -19,8 +19,10 @@
 #
 
 from struct import pack, unpack
+import numpy
 import os
 
+from tzxlib.csw import decodeCsw, COMPRESSION_ZRLE
 from tzxlib.tapfile import TapFile
 from tzxlib.saver import TapeSaver
 
@@ -68,9 +70,31 @@ class TzxbBlock():
         self.data = bytearray()
 
     def read(self, tzx):
+        self.readBody(tzx.read(self.readHeader(tzx)))
+
+    def readHeader(self, tzx):
+        """ Reads the block header, returns the length of the block body that follows """
         self.data = tzx.read(0x04)
-        len = unpack('<L', self.data)[0]
-        self.data += tzx.read(len)
+        return unpack('<L', self.data)[0]
+
+    def readBody(self, body):
+        """ Sets the block body that follows the block header """
+        self.data += body
+
+    def readMapped(self, tzx):
+        """
+        Reads the block from a MappedFile. Blocks with large bodies keep a view
+        of the mapped file instead of a copy.
+        """
+        start = tzx.tell()
+        length = self.readHeader(tzx)
+        headerLength = tzx.tell() - start
+        tzx.seek(start)
+        self.mapBody(tzx.readView(headerLength + length), headerLength)
+
+    def mapBody(self, view, headerLength):
+        """ Sets the block from a view of the mapped file, starting with the block header """
+        self.readBody(view[headerLength:].tobytes())
 
     def write(self, tzx):
         tzx.write(bytes([self.id]))
@@ -88,6 +112,10 @@ class TzxbBlock():
     def playback(self, saver:TapeSaver):
         yield from ()
 
+    def duration(self, saver:TapeSaver):
+        """ Returns the playing time in ns, and updates the saver state like playback() """
+        return saver.duration(self)
+
     def __str__(self):
         return ''
 
@@ -100,10 +128,16 @@ class TzxbData(TzxbBlock):
         self.tap = tap
         self.data = pack('<HH', 1000, len(tap.data))
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x04)
         len = unpack('<H', self.data[0x02:0x04])[0]
-        self.tap = TapFile.create(tzx.read(len))
+        return len
+
+    def readBody(self, body):
+        self.tap = TapFile.create(body)
+
+    def mapBody(self, view, headerLength):
+        self.readBody(view[headerLength:])
 
     def write(self, tzx):
         TzxbBlock.write(self, tzx)
@@ -120,8 +154,8 @@ class TzxbData(TzxbBlock):
         return self.tap.body()
 
     def playback(self, saver:TapeSaver):
-        yield from saver.saveTapFile(self.tap)
-        yield from saver.pause(unpack('<H', self.data[0x00:0x02])[0])
+        yield saver.saveTapFile(self.tap)
+        yield saver.pause(unpack('<H', self.data[0x00:0x02])[0])
 
     def __str__(self):
         return str(self.tap)
@@ -131,11 +165,17 @@ class TzxbTurboData(TzxbBlock):
     id = 0x11
     type = 'Turbo Speed Data Block'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x12)
         len = unpack('<BBB', self.data[0x0F:0x12])
         len = len[2] << 16 | len[1] << 8 | len[0]
-        self.tap = TapFile.create(tzx.read(len))
+        return len
+
+    def readBody(self, body):
+        self.tap = TapFile.create(body)
+
+    def mapBody(self, view, headerLength):
+        self.readBody(view[headerLength:])
 
     def write(self, tzx):
         TzxbBlock.write(self, tzx)
@@ -170,10 +210,10 @@ class TzxbTurboData(TzxbBlock):
 
     def playback(self, saver:TapeSaver):
         (pilot, sync1, sync2, zerobit, onebit, tone, bits) = unpack('<HHHHHHB', self.data[0x00:0x0D])
-        yield from saver.saveTapFile(self.tap,
+        yield saver.saveTapFile(self.tap,
             pilotPulse=pilot, syncHiPulse=sync1, syncLoPulse=sync2,
             zeroPulse=zerobit, onePulse=onebit, leaderTone=tone, finalBits=bits)
-        yield from saver.pause(unpack('<H', self.data[0x0D:0x0F])[0])
+        yield saver.pause(unpack('<H', self.data[0x0D:0x0F])[0])
 
     def __str__(self):
         return str(self.tap)
@@ -183,44 +223,49 @@ class TzxbPureTone(TzxbBlock):
     id = 0x12
     type = 'Pure Tone'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x04)
+        return 0
 
     def info(self):
         return '%d x %d T-states' % unpack('<HH', self.data)
 
     def playback(self, saver:TapeSaver):
         (length, number) = unpack('<HH', self.data[0x00:0x04])
-        yield from saver.tone(length, number)
+        yield saver.tone(length, number)
 
 
 class TzxbPulseSequence(TzxbBlock):
     id = 0x13
     type = 'Pulse Sequence'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x01)
         len = unpack('<B', self.data)[0]
-        self.data += tzx.read(len * 2)
+        return len * 2
 
     def info(self):
         return '{} pulses'.format((len(self.data)-1) // 2)
 
     def playback(self, saver:TapeSaver):
-        for i in range(1, len(self.data), 2):
-            length = unpack('<H', self.data[i:i+2])[0]
-            yield from saver.pulse(length)
+        yield saver.pulses(numpy.frombuffer(bytes(self.data[1:]), dtype='<u2'))
 
 
 class TzxbPureData(TzxbBlock):
     id = 0x14
     type = 'Pure Data Block'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x0A)
         len = unpack('<BBB', self.data[0x07:0x0A])
         len = len[2] << 16 | len[1] << 8 | len[0]
-        self.tap = TapFile.create(tzx.read(len))
+        return len
+
+    def readBody(self, body):
+        self.tap = TapFile.create(body)
+
+    def mapBody(self, view, headerLength):
+        self.readBody(view[headerLength:])
 
     def write(self, tzx):
         TzxbBlock.write(self, tzx)
@@ -238,10 +283,10 @@ class TzxbPureData(TzxbBlock):
 
     def playback(self, saver:TapeSaver):
         (zerobit, onebit, bits, pause) = unpack('<HHBH', self.data[0x00:0x07])
-        yield from saver.saveTapFile(self.tap,
+        yield saver.saveTapFile(self.tap,
             pilotPulse=None, syncHiPulse=None, syncLoPulse=None,
             zeroPulse=zerobit, onePulse=onebit, finalBits=bits)
-        yield from saver.pause(pause)
+        yield saver.pause(pause)
 
     def __str__(self):
         return str(self.tap)
@@ -251,26 +296,32 @@ class TzxbDirectRecording(TzxbBlock):
     id = 0x15
     type = 'Direct Recording'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x08)
         len = unpack('<BBB', self.data[0x05:0x08])
         len = len[2] << 16 | len[1] << 8 | len[0]
-        self.data += tzx.read(len)
+        return len
+
+    def mapBody(self, view, headerLength):
+        self.data = view
 
     def playback(self, saver:TapeSaver):
         (tstates, pause, bits) = unpack('<HHB', self.data[0x00:0x05])
-        yield from saver.saveDirect(self.data[0x08:], bits, tstates)
-        yield from saver.pause(pause)
+        yield saver.saveDirect(self.data[0x08:], bits, tstates)
+        yield saver.pause(pause)
 
 
 class TzxbC64Data(TzxbBlock): # deprecated
     id = 0x16
     type = 'C64 ROM type data'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x04)
         len = unpack('<L', self.data)[0]
-        self.data += tzx.read(len - 4)
+        return len - 4
+
+    def mapBody(self, view, headerLength):
+        self.data = view
 
     def dump(self):
         return self.data[0x28:]
@@ -283,10 +334,13 @@ class TzxbC64TurboData(TzxbBlock): # deprecated
     id = 0x17
     type = 'C64 turbo tape data'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x04)
         len = unpack('<L', self.data)[0]
-        self.data += tzx.read(len - 4)
+        return len - 4
+
+    def mapBody(self, view, headerLength):
+        self.data = view
 
     def dump(self):
         return self.data[0x16:]
@@ -299,24 +353,84 @@ class TzxbCswRecording(TzxbBlock):
     id = 0x18
     type = 'CSW recording'
 
+    def mapBody(self, view, headerLength):
+        self.data = view
+
+    def sampleRate(self):
+        rate = unpack('<BBB', self.data[0x06:0x09])
+        return rate[2] << 16 | rate[1] << 8 | rate[0]
+
+    def info(self):
+        (pause, compression, pulses) = unpack('<HxxxBL', self.data[0x04:0x0E])
+        return '{} pulses, {} Hz, {}, {} ms pause'.format(
+            pulses, self.sampleRate(), 'Z-RLE' if compression == COMPRESSION_ZRLE else 'RLE', pause)
+
     def playback(self, saver:TapeSaver):
-        raise NotImplementedError('CSW Recording Block is not supported yet')
+        (pause, compression, count) = unpack('<HxxxBL', self.data[0x04:0x0E])
+        lengths = decodeCsw(self.data[0x0E:], compression, count)
+        yield saver.samplePulses(lengths, self.sampleRate())
+        yield saver.pause(pause)
 
 
 class TzxbGeneralizedData(TzxbBlock):
     id = 0x19
     type = 'Generalized data'
 
+    def mapBody(self, view, headerLength):
+        self.data = view
+
+    def info(self):
+        (pause, totp, npp, asp, totd, npd, asd) = unpack('<HLBBLBB', self.data[0x04:0x12])
+        return '{} pilot/sync symbols, {} data symbols, {} ms pause'.format(totp, totd, pause)
+
     def playback(self, saver:TapeSaver):
-        raise NotImplementedError('Generalized Data Block is not supported yet')
+        (pause, streams) = self._symbolStreams()
+        for (table, symbols) in streams:
+            yield saver.symbols(*table, symbols)
+        yield saver.pause(pause)
+
+    def _symbolStreams(self):
+        """ Returns the pause, and the symbol tables and symbol sequences of the pilot and data streams """
+        (pause, totp, npp, asp, totd, npd, asd) = unpack('<HLBBLBB', self.data[0x04:0x12])
+        streams = []
+        pos = 0x12
+
+        # Pilot and sync symbols, run length encoded
+        if totp > 0:
+            (pilotTable, pos) = self._symbolTable(pos, npp, asp or 256)
+            prle = numpy.frombuffer(bytes(self.data[pos:pos + totp * 3]), dtype=[('symbol', 'u1'), ('repeat', '<u2')])
+            pos += totp * 3
+            streams.append((pilotTable, numpy.repeat(prle['symbol'], prle['repeat'])))
+
+        # Data symbols, packed with the minimum number of bits per symbol. With
+        # a single symbol, there are no data bytes, and all symbols are 0.
+        if totd > 0:
+            (dataTable, pos) = self._symbolTable(pos, npd, asd or 256)
+            bitsPerSymbol = ((asd or 256) - 1).bit_length()
+            if bitsPerSymbol == 0:
+                streams.append((dataTable, numpy.zeros(totd, dtype=numpy.int64)))
+                return (pause, streams)
+            count = (totd * bitsPerSymbol + 7) // 8
+            bits = numpy.unpackbits(numpy.frombuffer(bytes(self.data[pos:pos + count]), dtype=numpy.uint8))
+            bits = bits[0:totd * bitsPerSymbol].reshape(-1, bitsPerSymbol)
+            streams.append((dataTable, bits.astype(numpy.int64) @ (1 << numpy.arange(bitsPerSymbol - 1, -1, -1))))
+
+        return (pause, streams)
+
+    def _symbolTable(self, pos, maxPulses, size):
+        """ Reads a symbol definition table, returns the flags and pulse lengths of each symbol """
+        symdef = numpy.dtype([('flags', 'u1'), ('pulses', '<u2', (maxPulses,))])
+        table = numpy.frombuffer(bytes(self.data[pos:pos + size * symdef.itemsize]), dtype=symdef)
+        return ((table['flags'], table['pulses'].reshape(size, maxPulses)), pos + size * symdef.itemsize)
 
 
 class TzxbPause(TzxbBlock):
     id = 0x20
     type = 'Pause'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x02)
+        return 0
 
     def length(self):
         return unpack('<H', self.data)[0]
@@ -328,17 +442,17 @@ class TzxbPause(TzxbBlock):
         return '%d ms' % (self.length())
 
     def playback(self, saver:TapeSaver):
-        yield from saver.pause(self.length())
+        yield saver.pause(self.length())
 
 
 class TzxbGroupStart(TzxbBlock):
     id = 0x21
     type = 'Group start'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x01)
         len = unpack('<B', self.data)[0]
-        self.data += tzx.read(len)
+        return len
 
     def __str__(self):
         return self.data[1:].decode('ISO-8859-15').strip()
@@ -348,16 +462,17 @@ class TzxbGroupEnd(TzxbBlock):
     id = 0x22
     type = 'Group end'
 
-    def read(self, tzx):
-        pass
+    def readHeader(self, tzx):
+        return 0
 
 
 class TzxbJumpTo(TzxbBlock):
     id = 0x23
     type = 'Jump to'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x02)
+        return 0
 
     def relative(self):
         return unpack('<h', self.data)[0]
@@ -370,8 +485,9 @@ class TzxbLoopStart(TzxbBlock):
     id = 0x24
     type = 'Loop start'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x02)
+        return 0
 
     def repeats(self):
         return unpack('<h', self.data)[0]
@@ -384,36 +500,44 @@ class TzxbLoopEnd(TzxbBlock):
     id = 0x25
     type = 'Loop end'
 
-    def read(self, tzx):
-        pass
+    def readHeader(self, tzx):
+        return 0
 
 
 class TzxbCallSequence(TzxbBlock):
     id = 0x26
     type = 'Call sequence'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x02)
         len = unpack('<H', self.data)[0]
-        self.data += tzx.read(len * 2)
+        return len * 2
+
+    def calls(self):
+        """ Returns the relative offsets of all called blocks """
+        count = unpack('<H', self.data[0x00:0x02])[0]
+        return list(unpack('<%dh' % (count), self.data[0x02:0x02 + count * 2]))
+
+    def __str__(self):
+        return ', '.join(str(c) for c in self.calls())
 
 
 class TzxbReturn(TzxbBlock):
     id = 0x27
     type = 'Return from sequence'
 
-    def read(self, tzx):
-        pass
+    def readHeader(self, tzx):
+        return 0
 
 
 class TzxbSelect(TzxbBlock):
     id = 0x28
     type = 'Select'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x02)
         len = unpack('<H', self.data)[0]
-        self.data += tzx.read(len)
+        return len
 
 
 class TzxbStopTape48k(TzxbBlock):
@@ -436,10 +560,10 @@ class TzxbTextDescription(TzxbBlock):
     id = 0x30
     type = 'Text description'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x01)
         len = unpack('<B', self.data)[0]
-        self.data += tzx.read(len)
+        return len
 
     def writeTap(self, out):
         return False
@@ -455,10 +579,10 @@ class TzxbMessage(TzxbBlock):
     id = 0x31
     type = 'Message'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x02)
         len = unpack('<xB', self.data)[0]
-        self.data += tzx.read(len)
+        return len
 
     def writeTap(self, out):
         return False
@@ -478,24 +602,32 @@ class TzxbArchiveInfo(TzxbBlock):
         'Language', 'Type', 'Price', 'Loader', 'Origin'
     ]
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x02)
         len = unpack('<H', self.data)[0]
-        self.data += tzx.read(len)
+        return len
 
     def writeTap(self, out):
         return False
 
-    def info(self):
-        result = ''
+    def entries(self):
+        """ Returns a list of the identification and text of all entries """
+        result = []
         ix = 0x03
         for _ in range(self.data[2]):
             (tp, tl) = unpack('BB', self.data[ix:ix+2])
-            result += self.identifications[tp] if 0 <= tp < len(self.identifications) else 'Comment'
+            name = self.identifications[tp] if 0 <= tp < len(self.identifications) else 'Comment'
+            result.append((name, self.data[ix+2:ix+2+tl].decode('ISO-8859-15')))
+            ix += 2 + tl
+        return result
+
+    def info(self):
+        result = ''
+        for (name, text) in self.entries():
+            result += name
             result += ': '
-            result += self.data[ix+2:ix+2+tl].decode('ISO-8859-15').replace('\r', '\n').replace('\n', '\n\t').strip()
+            result += text.replace('\r', '\n').replace('\n', '\n\t').strip()
             result += os.linesep
-            ix += 2 + tl
         return result
 
 
@@ -503,10 +635,10 @@ class TzxbHardwareType(TzxbBlock):
     id = 0x33
     type = 'Hardware type'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x01)
         len = unpack('<B', self.data)[0]
-        self.data += tzx.read(len * 3)
+        return len * 3
 
     def writeTap(self, out):
         return False
@@ -516,18 +648,19 @@ class TzxbEmulationInfo(TzxbBlock): # deprecated
     id = 0x34
     type = 'Emulation info'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x08)
+        return 0
 
 
 class TzxbCustomInfo(TzxbBlock):
     id = 0x35
     type = 'Custom info'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x14)
         len = unpack('<L', self.data[0x10:0x14])[0]
-        self.data += tzx.read(len)
+        return len
 
     def writeTap(self, out):
         return False
@@ -550,17 +683,23 @@ class TzxbSnapshot(TzxbBlock): # deprecated
     id = 0x40
     type = 'Snapshot'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         self.data = tzx.read(0x04)
         len = unpack('<BBB', self.data[0x01:0x04])
         len = len[2] << 16 | len[1] << 8 | len[0]
-        self.data += tzx.read(len)
+        return len
+
+    def mapBody(self, view, headerLength):
+        self.data = view
 
 
 class TzxbKansasCityStandard(TzxbBlock):
     id = 0x4B
     type = 'Kansas City Standard'
 
+    def mapBody(self, view, headerLength):
+        self.data = view
+
     def dump(self):
         return self.data[0x10:]
 
@@ -575,8 +714,9 @@ class TzxbGlue(TzxbBlock):
     id = 0x5A
     type = 'Glue'
 
-    def read(self, tzx):
+    def readHeader(self, tzx):
         tzx.read(0x09)
+        return 0
 
     def write(self, tzx):
         pass    # never write the glue block, it serves no purpose
@@ -18,12 +18,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from collections.abc import MutableSequence
 import io
-from struct import unpack
+import mmap
+import os
+import stat
+from struct import pack, unpack
 import sys
 
 from tzxlib.tapfile import TapFile
-from tzxlib.tzxblocks import TzxbBlock, TzxbData
+from tzxlib.tzxblocks import TzxbBlock, TzxbData, TzxbGlue
 
 class TzxFile():
     MAJOR = 1
@@ -35,48 +39,119 @@ class TzxFile():
     def _reset(self):
         self.version = (TzxFile.MAJOR, TzxFile.MINOR)
         self.blocks = list()
+        self._file = None
 
-    def read(self, input):
+    def read(self, input, lazy=False):
+        """
+        Reads a TZX or TAP file. In lazy mode, only the block headers are read,
+        and the blocks are a LazyBlocks instance that reads the block bodies on
+        access. The file is then kept open until close() is invoked. Files that
+        cannot be seeked are always read completely.
+        """
+        self.close()
         self._reset()
-        inf = input
-        if isinstance(inf, io.TextIOWrapper):
-            inf = inf.buffer
-        with io.BufferedReader(inf) if isinstance(inf, io.IOBase) else open(inf, 'rb') as tzx:
-            identifier = tzx.peek(8)
-            if identifier[0:7].decode('ascii') != 'ZXTape!' or identifier[7] != 0x1A:
-                self._readTap(tzx)
+        tzx = TzxFile._open(input)
+        if lazy and tzx.seekable():
+            self.blocks = LazyBlocks(tzx)
+        try:
+            tap = TzxFile._isTap(tzx)
+            if not tap:
+                self.version = TzxFile._readHeader(tzx)
+            if isinstance(self.blocks, LazyBlocks):
+                self._scan(tzx, tap)
             else:
-                self._readTzx(tzx)
+                self.blocks.extend(TzxFile._iterBlocks(tzx, tap))
+        except BaseException:
+            tzx.close()
+            raise
+        if isinstance(self.blocks, LazyBlocks):
+            self._file = tzx
+        else:
+            tzx.close()
+            if lazy:
+                self.blocks = LazyBlocks(None, self.blocks)
+
+    def iterBlocks(input, mapped=False):
+        """
+        Reads a TZX or TAP file, and yields each block as soon as it was read.
+        Only the current block is kept in memory, and the file can also be a
+        pipe. In mapped mode, the file is mapped into memory if possible.
+        """
+        tzx = TzxFile._open(input, mapped)
+        try:
+            tap = TzxFile._isTap(tzx)
+            if not tap:
+                TzxFile._readHeader(tzx)
+            yield from TzxFile._iterBlocks(tzx, tap)
+        finally:
+            tzx.close()
+
+    def close(self):
+        """ Closes the file that was read in lazy mode """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
     def write(self, output):
-        outf = output
-        if isinstance(outf, io.TextIOWrapper):
-            outf = outf.buffer
-        with outf if isinstance(outf, io.IOBase) else open(outf, 'wb') as tzx:
-            self._writeHeader(tzx)
+        with TzxWriter(output) as tzx:
             for b in self.blocks:
-                b.write(tzx)
+                tzx.write(b)
 
-    def _readTap(self, tap):
-        self.version = (self.MAJOR, self.MINOR)
+    def _open(input, mapped=False):
+        inf = input
+        if isinstance(inf, io.TextIOWrapper):
+            inf = inf.buffer
+        tzx = io.BufferedReader(inf) if isinstance(inf, io.IOBase) else open(inf, 'rb')
+        if mapped:
+            try:
+                mapping = MappedFile(tzx)
+                tzx.close()
+                return mapping
+            except (OSError, ValueError):
+                pass
+        return tzx
+
+    def _isTap(tzx):
+        identifier = tzx.peek(8)
+        return identifier[0:7] != b'ZXTape!' or identifier[7:8] != b'\x1A'
+
+    def _iterBlocks(tzx, tap):
+        mapped = isinstance(tzx, MappedFile)
         while True:
-            blockLen = tap.read(2)
-            if not blockLen: break
-            len = unpack('<H', blockLen)[0]
-            block = TzxbData()
-            block.setup(TapFile.create(tap.read(len)))
-            self.blocks.append(block)
-
-    def _readTzx(self, tzx):
-        self.version = self._readHeader(tzx)
+            if tap:
+                blockLen = tzx.read(2)
+                if not blockLen: break
+                len = unpack('<H', blockLen)[0]
+                block = TzxbData()
+                block.setup(TapFile.create(tzx.readView(len) if mapped else tzx.read(len)))
+            else:
+                blockType = tzx.read(1)
+                if not blockType: break
+                block = TzxbBlock.createBlock(blockType[0])
+                if mapped:
+                    block.readMapped(tzx)
+                else:
+                    block.read(tzx)
+            yield block
+
+    def _scan(self, tzx, tap):
+        self.blocks.copyable = not tap
         while True:
-            blockType = tzx.read(1)
-            if not blockType: break
-            block = TzxbBlock.createBlock(blockType[0])
-            block.read(tzx)
-            self.blocks.append(block)
+            offset = tzx.tell()
+            if tap:
+                blockLen = tzx.read(2)
+                if not blockLen: break
+                len = unpack('<H', blockLen)[0]
+                block = TzxbData()
+                block.data = pack('<HH', 1000, len)
+            else:
+                blockType = tzx.read(1)
+                if not blockType: break
+                block = TzxbBlock.createBlock(blockType[0])
+                len = block.readHeader(tzx)
+            self.blocks.scan(block, offset, len)
 
-    def _readHeader(self, tzx):
+    def _readHeader(tzx):
         header = tzx.read(10)
         if header[0:7].decode('ascii') != 'ZXTape!' or header[7] != 0x1A:
             raise IOError('Not a TZX file')
@@ -84,6 +159,269 @@ class TzxFile():
             raise IOError('Cannot handle TZX with major version %d' % (header[8]))
         return (header[8], header[9])
 
-    def _writeHeader(self, tzx):
-        tzx.write('ZXTape!'.encode('ascii'))
-        tzx.write(bytes([0x1A, TzxFile.MAJOR, TzxFile.MINOR]))
+
+class LazyBlocks(MutableSequence):
+    """
+    The blocks of a file that was read in lazy mode. When the file is scanned,
+    only the block headers are read, and the offset and length of each block is
+    recorded. The block body is read from the file when the block is accessed
+    for the first time. Blocks can be peeked at without reading the body.
+    """
+
+    def __init__(self, file, blocks=()):
+        self.file = file
+        self.copyable = False   # True if the file contains TZX blocks that can be copied verbatim
+        # block, offset, body offset, body length, body was read
+        self.entries = [[b, None, None, None, True] for b in blocks]
+
+    def scan(self, block, offset, length):
+        """ Adds a block with the given offset, its header was just read. Skips the block body. """
+        bodyOffset = self.file.tell()
+        self.entries.append([block, offset, bodyOffset, length, False])
+        self.file.seek(length, io.SEEK_CUR)
+
+    def peek(self, index):
+        """ Returns the block, but only its header is available if the body was not read yet """
+        return self.entries[index][0]
+
+    def offset(self, index):
+        """ Returns the offset of the block in the file, or None if it is not from the file """
+        return self.entries[index][1]
+
+    def length(self, index):
+        """ Returns the length of the block in the file, or None if it is not from the file """
+        entry = self.entries[index]
+        return entry[2] + entry[3] - entry[1] if entry[1] is not None else None
+
+    def bodyLength(self, index):
+        """ Returns the length of the block body in the file, or None if it is not from the file """
+        return self.entries[index][3]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[ix] for ix in range(*index.indices(len(self)))]
+        entry = self.entries[index]
+        if not entry[4]:
+            self.file.seek(entry[2])
+            entry[0].readBody(self.file.read(entry[3]))
+            entry[4] = True
+        return entry[0]
+
+    def __setitem__(self, index, block):
+        if isinstance(index, slice):
+            self.entries[index] = [[b, None, None, None, True] for b in block]
+        else:
+            self.entries[index] = [block, None, None, None, True]
+
+    def __delitem__(self, index):
+        del self.entries[index]
+
+    def insert(self, index, block):
+        self.entries.insert(index, [block, None, None, None, True])
+
+
+class MappedFile():
+    """
+    A file that is mapped into memory for reading. read() returns a copy of the
+    data, while readView() returns a view of the mapped file. If views are still
+    in use when the file is closed, the mapping is released by the garbage
+    collector after the last view was discarded.
+    """
+
+    def __init__(self, file):
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.pos = file.tell()
+
+    def read(self, size=-1):
+        return self.readView(size).tobytes()
+
+    def readView(self, size=-1):
+        """ Reads up to size bytes, and returns them as a view of the mapped file """
+        start = min(self.pos, len(self.view))
+        end = len(self.view) if size < 0 else min(start + size, len(self.view))
+        self.pos = end
+        return self.view[start:end]
+
+    def peek(self, size=1):
+        return self.view[self.pos:self.pos + size].tobytes()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            try:
+                self.map.close()
+            except BufferError:
+                pass    # views of blocks are still in use
+
+
+class TzxWriter():
+    """
+    Writes a TZX file block by block. The header is written when the file is
+    opened, so the file is valid after each written block.
+
+    If the target has a file descriptor, the parts of the blocks are collected
+    and written with writev(), so views of mapped files are written without
+    copying them into a buffer first.
+    """
+
+    def __init__(self, output, flush=False):
+        outf = output
+        if isinstance(outf, io.TextIOWrapper):
+            outf = outf.buffer
+        self.tzx = outf if isinstance(outf, io.IOBase) else open(outf, 'wb')
+        self.flush = flush
+        self.fd = self._fileno()
+        self.parts = _Parts()
+        self._writeHeader()
+
+    def write(self, block):
+        """ Appends a block to the TZX file """
+        if self.fd is not None:
+            block.write(self.parts)
+            if self.flush or self.parts.size >= 0x10000:
+                self._writeParts()
+            return
+        block.write(self.tzx)
+        if self.flush:
+            self.tzx.flush()
+
+    def copy(self, blocks, indexes):
+        """
+        Appends the blocks with the given indexes of a LazyBlocks instance. The
+        blocks are copied from the file without parsing them, consecutive blocks
+        are copied in one go. Glue blocks are dropped. Blocks that are not
+        stored in a TZX file are written normally.
+        """
+        start = None
+        end = None
+        for ix in indexes:
+            offset = blocks.offset(ix) if blocks.copyable else None
+            if offset is not None and blocks.peek(ix).id == TzxbGlue.id:
+                continue
+            if offset is not None and offset == end:
+                end += blocks.length(ix)
+                continue
+            if start is not None:
+                self._copyRange(blocks.file, start, end - start)
+            if offset is not None:
+                start = offset
+                end = offset + blocks.length(ix)
+            else:
+                start = None
+                end = None
+                self.write(blocks[ix])
+        if start is not None:
+            self._copyRange(blocks.file, start, end - start)
+
+    def close(self):
+        if self.fd is not None:
+            self._writeParts()
+        self.tzx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _writeHeader(self):
+        header = 'ZXTape!'.encode('ascii') + bytes([0x1A, TzxFile.MAJOR, TzxFile.MINOR])
+        if self.fd is not None:
+            self.parts.write(header)
+            self._writeParts()
+        else:
+            self.tzx.write(header)
+
+    def _fileno(self):
+        if not hasattr(os, 'writev'):
+            return None
+        try:
+            fd = self.tzx.fileno()
+        except (OSError, ValueError):
+            return None
+        self.tzx.flush()    # the file descriptor is written directly from now on
+        return fd
+
+    def _copyRange(self, file, offset, length):
+        if self.fd is not None:
+            self._writeParts()
+            copied = self._copyFile(file, offset, length)
+            offset += copied
+            length -= copied
+        while length > 0:
+            file.seek(offset)
+            data = file.read(min(length, 0x100000))
+            if not data: break
+            if self.fd is not None:
+                self.parts.write(data)
+                self._writeParts()
+            else:
+                self.tzx.write(data)
+            offset += len(data)
+            length -= len(data)
+        if self.flush and self.fd is None:
+            self.tzx.flush()
+
+    def _copyFile(self, file, offset, length):
+        # Let the kernel copy the data if possible, returns the number of copied bytes
+        copied = 0
+        try:
+            source = file.fileno()
+            if hasattr(os, 'copy_file_range') \
+                    and stat.S_ISREG(os.fstat(source).st_mode) \
+                    and stat.S_ISREG(os.fstat(self.fd).st_mode):
+                while copied < length:
+                    count = os.copy_file_range(source, self.fd, length - copied, offset + copied)
+                    if count == 0: break
+                    copied += count
+            elif hasattr(os, 'sendfile'):
+                while copied < length:
+                    count = os.sendfile(self.fd, source, offset + copied, length - copied)
+                    if count == 0: break
+                    copied += count
+        except (OSError, ValueError):
+            pass    # copy the remaining data through memory
+        return copied
+
+    def _writeParts(self):
+        views = [memoryview(b).cast('B') for b in self.parts.buffers if len(b) > 0]
+        self.parts = _Parts()
+        ix = 0
+        while ix < len(views):
+            written = os.writev(self.fd, views[ix:ix + 1024])
+            while ix < len(views) and written >= len(views[ix]):
+                written -= len(views[ix])
+                ix += 1
+            if written > 0:
+                views[ix] = views[ix][written:]
+
+
+class _Parts():
+    """ Collects the written parts of blocks, small parts are copied """
+
+    def __init__(self):
+        self.buffers = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffers.append(bytes(data) if len(data) < 0x1000 else data)
+        self.size += len(data)
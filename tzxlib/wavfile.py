@@ -0,0 +1,137 @@
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import io
+import mmap
+import os
+import stat
+from struct import unpack
+import wave
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def openWave(input):
+    """ Opens a WAV file, memory-mapped if possible, via the wave module otherwise """
+    if isMappable(input):
+        return MappedWave(input)
+    return wave.open(input, 'rb')
+
+def isMappable(input):
+    """ Checks if the input is a regular file that can be memory-mapped """
+    try:
+        if isinstance(input, (str, bytes, os.PathLike)):
+            st = os.stat(input)
+        else:
+            st = os.fstat(input.fileno())
+        return stat.S_ISREG(st.st_mode) and st.st_size > 0
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+
+
+class MappedWave():
+    """
+    Reads a PCM WAV file by memory-mapping it. The RIFF header is parsed once,
+    frames are returned as memoryview slices of the mapped data chunk, so
+    positioning is done in constant time and no data is copied.
+
+    Offers the same methods as the reader of the wave module.
+    """
+
+    def __init__(self, input):
+        if isinstance(input, (str, bytes, os.PathLike)):
+            with open(input, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            self._readHeader()
+        except:
+            self.map.close()
+            raise
+        self.view = memoryview(self.map)[self.dataStart:self.dataStart + self.nframes * self.frameSize]
+        self.pos = 0
+
+    def _readHeader(self):
+        if len(self.map) < 12 or self.map[0:4] != b'RIFF' or self.map[8:12] != b'WAVE':
+            raise IOError('Not a WAV file')
+        fmt = None
+        ix = 12
+        while ix + 8 <= len(self.map):
+            (chunkId, chunkLen) = unpack('<4sL', self.map[ix:ix+8])
+            ix += 8
+            if chunkId == b'fmt ':
+                fmt = unpack('<HHLLHH', self.map[ix:ix+16])
+            elif chunkId == b'data':
+                if fmt is None:
+                    raise IOError('WAV file has no format chunk')
+                (tag, self.channels, self.rate, _, _, bits) = fmt
+                if tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE):
+                    raise IOError('Cannot handle WAV files with format {}'.format(tag))
+                self.sampleWidth = (bits + 7) // 8
+                self.frameSize = self.channels * self.sampleWidth
+                # Data length may be bogus for recordings that were not finished properly
+                dataLen = min(chunkLen, len(self.map) - ix)
+                self.dataStart = ix
+                self.nframes = dataLen // self.frameSize
+                return
+            ix += chunkLen + (chunkLen & 1)
+        raise IOError('WAV file has no data chunk')
+
+    def getnchannels(self):
+        return self.channels
+
+    def getsampwidth(self):
+        return self.sampleWidth
+
+    def getframerate(self):
+        return self.rate
+
+    def getnframes(self):
+        return self.nframes
+
+    def tell(self):
+        return self.pos
+
+    def setpos(self, pos):
+        if pos < 0 or pos > self.nframes:
+            raise IOError('position not in range')
+        self.pos = pos
+
+    def readframes(self, nframes):
+        """ Returns a memoryview of the next frames, without copying them """
+        start = self.pos
+        self.pos = min(self.pos + nframes, self.nframes)
+        return self.view[start * self.frameSize:self.pos * self.frameSize]
+
+    def close(self):
+        """
+        Closes the file. If frames returned by readframes() are still in use,
+        the mapping is closed by the garbage collector after they were dropped.
+        """
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            try:
+                self.map.close()
+            except BufferError:
+                pass
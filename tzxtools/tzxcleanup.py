@@ -22,7 +22,7 @@
 import argparse
 import sys
 
-from tzxlib.tzxfile import TzxFile
+from tzxlib.tzxfile import TzxFile, TzxWriter
 from tzxlib.tapfile import TapHeader
 
 def main():
@@ -52,69 +52,73 @@ def main():
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    fout = TzxFile()
+    blockCnt = 0
+    writtenCnt = 0
     crcCnt = 0
     noiseCnt = 0
     headerlessCnt = 0
 
-    file = TzxFile()
-    file.read(args.file)
-    blocklengthfromheader = 0
-    for b in file.blocks:
-        # Convert Turbo blocks to standard timed blocks if possible
-        if b.id == 0x11:
-            b = b.asData()
+    with TzxWriter(args.to) as fout:
+        blocklengthfromheader = 0
+        for b in TzxFile.iterBlocks(args.file, mapped=True):
+            blockCnt += 1
 
-        # when args.headermustmatch keep last header found
-        if args.headermustmatch and b.id == 0x10 and b.valid() and isinstance(b.tap, TapHeader):
-            if blocklengthfromheader != 0:
-                # header after header makes the first one a orphan header
-                print("Orphan header: {} ({})".format(lastheader.tap.name(), blocklengthfromheader), file=sys.stderr)
-                headerlessCnt = headerlessCnt + 1
-            lastheader = b
-            blocklengthfromheader = lastheader.tap.length()
-            continue
+            # Convert Turbo blocks to standard timed blocks if possible
+            if b.id == 0x11:
+                b = b.asData()
 
-        # Use all data blocks for the output
-        if b.id in [0x10, 0x11, 0x14]:
-            if not b.valid():
-                crcCnt += 1
-            if b.valid() or not args.stripcrc:
-                if args.headermustmatch:
-                    if blocklengthfromheader == len(b.tap.data) - 2 and not isinstance(b.tap, TapHeader):
-                        # this is a datablock with matching header
-                        fout.blocks.append(lastheader)      # write header only now
-                        fout.blocks.append(b)
-                        blocklengthfromheader = 0
-                else:
-                    # as before.
-                    fout.blocks.append(b)
-            if blocklengthfromheader != 0:
-                print("Orphan header: {} ({})".format(lastheader.tap.name().strip(), blocklengthfromheader), file=sys.stderr)
-                headerlessCnt = headerlessCnt + 1
-                blocklengthfromheader = 0
-            continue
+            # when args.headermustmatch keep last header found
+            if args.headermustmatch and b.id == 0x10 and b.valid() and isinstance(b.tap, TapHeader):
+                if blocklengthfromheader != 0:
+                    # header after header makes the first one a orphan header
+                    print("Orphan header: {} ({})".format(lastheader.tap.name(), blocklengthfromheader), file=sys.stderr)
+                    headerlessCnt = headerlessCnt + 1
+                lastheader = b
+                blocklengthfromheader = lastheader.tap.length()
+                continue
 
-        blocklengthfromheader = 0
+            # Use all data blocks for the output
+            if b.id in [0x10, 0x11, 0x14]:
+                if not b.valid():
+                    crcCnt += 1
+                if b.valid() or not args.stripcrc:
+                    if args.headermustmatch:
+                        if blocklengthfromheader == len(b.tap.data) - 2 and not isinstance(b.tap, TapHeader):
+                            # this is a datablock with matching header
+                            fout.write(lastheader)      # write header only now
+                            fout.write(b)
+                            writtenCnt += 2
+                            blocklengthfromheader = 0
+                    else:
+                        # as before.
+                        fout.write(b)
+                        writtenCnt += 1
+                if blocklengthfromheader != 0:
+                    print("Orphan header: {} ({})".format(lastheader.tap.name().strip(), blocklengthfromheader), file=sys.stderr)
+                    headerlessCnt = headerlessCnt + 1
+                    blocklengthfromheader = 0
+                continue
 
-        # Use all pause blocks if they mean "stop the tape"
-        if b.id in [0x20, 0x2A]:
-            if b.id != 0x20 or b.length() == 0:
-                fout.blocks.append(b)
-            continue
+            blocklengthfromheader = 0
 
-        # Use all meta blocks
-        if b.id not in [0x12, 0x13, 0x15, 0x18, 0x19]:
-            fout.blocks.append(b)
-            continue
+            # Use all pause blocks if they mean "stop the tape"
+            if b.id in [0x20, 0x2A]:
+                if b.id != 0x20 or b.length() == 0:
+                    fout.write(b)
+                    writtenCnt += 1
+                continue
 
-        noiseCnt += 1
+            # Use all meta blocks
+            if b.id not in [0x12, 0x13, 0x15, 0x18, 0x19]:
+                fout.write(b)
+                writtenCnt += 1
+                continue
 
-    fout.write(args.to)
+            noiseCnt += 1
 
-    print('Blocks found:              %3d' % (len(file.blocks)), file=sys.stderr)
+    print('Blocks found:              %3d' % (blockCnt), file=sys.stderr)
     print('Noise blocks removed:      %3d' % (noiseCnt), file=sys.stderr)
     print('Blocks with CRC errors:    %3d' % (crcCnt), file=sys.stderr)
     if args.headermustmatch:
         print('Skipped headerless blocks: %3d' % (headerlessCnt), file=sys.stderr)
-    print('Blocks written:            %3d' % (len(fout.blocks)), file=sys.stderr)
+    print('Blocks written:            %3d' % (writtenCnt), file=sys.stderr)
@@ -25,7 +25,7 @@ import re
 import sys
 
 from tzxlib.tapfile import TapHeader
-from tzxlib.tzxfile import TzxFile
+from tzxlib.tzxfile import TzxFile, TzxWriter
 
 def appendRange(ranges, v1, v2, lastBlock):
     if v1 < 0: v1 += lastBlock
@@ -67,9 +67,14 @@ def main():
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    file = TzxFile()
-    file.read(args.file)
-    lastBlock = len(file.blocks)
+    # Files are indexed so the blocks can be copied without parsing them. Pipes
+    # are streamed, unless counting from the end requires the number of blocks.
+    file = None
+    lastBlock = sys.maxsize
+    if args.file.seekable() or any(re.match(r'^(.*:)?-', rng) for rng in args.blocks):
+        file = TzxFile()
+        file.read(args.file, lazy=True)
+        lastBlock = len(file.blocks)
 
     ranges = []
     for rng in args.blocks:
@@ -97,12 +102,14 @@ def main():
         print('Illegal range: %s' % (rng), file=sys.stderr)
         exit(1)
 
-    fout = TzxFile()
-
-    count = 0
-    for b in file.blocks:
-        if isInRange(ranges, count) != args.invert:
-            fout.blocks.append(b)
-        count += 1
-
-    fout.write(args.to)
+    with TzxWriter(args.to) as fout:
+        if file is not None:
+            fout.copy(file.blocks, [count for count in range(lastBlock) if isInRange(ranges, count) != args.invert])
+            file.close()
+        else:
+            last = max((rng[1] for rng in ranges), default=-1)
+            for (count, b) in enumerate(TzxFile.iterBlocks(args.file)):
+                if count > last and not args.invert:
+                    break
+                if isInRange(ranges, count) != args.invert:
+                    fout.write(b)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import os
+import sys
+
+from tzxlib import catalog as cat
+
+headerTypes = { 'program': 0, 'numbers': 1, 'chars': 2, 'bytes': 3 }
+extensions = ('.tzx', '.tap', '.tsx')
+
+
+def findFiles(directory):
+    """ Yields all tape files in the directory and its subdirectories """
+    for (root, dirs, files) in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(extensions):
+                yield os.path.join(root, name)
+
+
+def scan(catalog, paths, verbose):
+    counts = { cat.ADDED: 0, cat.UPDATED: 0, cat.COPIED: 0, cat.UNCHANGED: 0, cat.FAILED: 0 }
+    removed = 0
+
+    def update(path):
+        result = catalog.update(path)
+        counts[result] += 1
+        if verbose and result != cat.UNCHANGED:
+            print('%-9s %s' % (result, path), file=sys.stderr)
+        if sum(counts.values()) % 500 == 0:
+            catalog.commit()
+
+    for path in paths:
+        if os.path.isdir(path):
+            seen = set()
+            for f in findFiles(path):
+                seen.add(os.path.abspath(f))
+                update(f)
+            for stale in catalog.paths(path):
+                if stale not in seen:
+                    catalog.remove(stale)
+                    removed += 1
+        elif os.path.isfile(path):
+            update(path)
+        else:
+            print('Warning: %s does not exist' % (path), file=sys.stderr)
+            catalog.remove(path)
+
+    print('Files added:     %6d' % (counts[cat.ADDED] + counts[cat.COPIED]), file=sys.stderr)
+    print('Files updated:   %6d' % (counts[cat.UPDATED]), file=sys.stderr)
+    print('Files unchanged: %6d' % (counts[cat.UNCHANGED]), file=sys.stderr)
+    print('Files removed:   %6d' % (removed), file=sys.stderr)
+    print('Newly unreadable:%6d' % (counts[cat.FAILED]), file=sys.stderr)
+    if counts[cat.FAILED] > 0:
+        print('Use "query -e" to list all unreadable files of the catalog', file=sys.stderr)
+
+
+def query(catalog, args):
+    if args.hash is not None:
+        for (path, number, type, description) in catalog.findBlocks(args.hash):
+            print('%s:%d: %-27s %s' % (path, number, type, description))
+    elif args.info:
+        for (path, number, field, value) in catalog.findInfo(args.pattern):
+            print('%s:%d: %s: %s' % (path, number, field, value))
+    elif args.errors:
+        for (path, number, message) in catalog.findErrors():
+            print('%s:%s: %s' % (path, '-' if number is None else number, message))
+    else:
+        headerType = headerTypes[args.type] if args.type is not None else None
+        for (path, number, description) in catalog.findHeaders(args.pattern, headerType):
+            print('%s:%d: %s' % (path, number, description))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog the contents of a collection of TZX files')
+    parser.add_argument('-d', '--database',
+                dest='database',
+                default='tzxindex.db',
+                help='catalog database file')
+    commands = parser.add_subparsers(dest='command')
+
+    scanParser = commands.add_parser('scan', help='add or update files in the catalog')
+    scanParser.add_argument('paths',
+                nargs='+',
+                help='TZX and TAP files, or directories to scan')
+    scanParser.add_argument('-v', '--verbose',
+                dest='verbose',
+                action='store_true',
+                help='show all added, updated and unreadable files')
+
+    queryParser = commands.add_parser('query', help='find files in the catalog')
+    queryParser.add_argument('pattern',
+                nargs='?',
+                default='*',
+                help='name to find, * and ? are wildcards, case is ignored')
+    queryParser.add_argument('-t', '--type',
+                dest='type',
+                choices=headerTypes.keys(),
+                help='only find headers of this type')
+    queryParser.add_argument('-i', '--info',
+                dest='info',
+                action='store_true',
+                help='find the pattern in the archive info instead of the header names')
+    queryParser.add_argument('-H', '--hash',
+                dest='hash',
+                help='find blocks with a content hash starting with this value')
+    queryParser.add_argument('-e', '--errors',
+                dest='errors',
+                action='store_true',
+                help='find unreadable files and blocks with bad CRC')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    if args.command == 'query' and not os.path.isfile(args.database):
+        print('Error: Catalog %s does not exist' % (args.database), file=sys.stderr)
+        sys.exit(1)
+
+    with cat.Catalog(args.database) as catalog:
+        if args.command == 'scan':
+            scan(catalog, args.paths, args.verbose)
+        else:
+            query(catalog, args)
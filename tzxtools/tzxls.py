@@ -24,9 +24,39 @@ import io
 import sys
 import textwrap
 
+from tzxlib.playplan import PlaybackPlan
 from tzxlib.tapfile import TapHeader
 from tzxlib.tzxfile import TzxFile
 
+def formatTime(ns):
+    millis = ns // 1000000
+    seconds = millis // 1000
+    return '%02d:%02d.%03d' % (seconds // 60, seconds % 60, millis % 1000)
+
+def blockTimes(tzx, cpufreq):
+    """ Returns the start time, total playing time and number of plays of each block """
+    times = [None] * len(tzx.blocks)
+    plan = PlaybackPlan(tzx, cpufreq)
+    for entry in plan.entries:
+        if times[entry.index] is None:
+            times[entry.index] = [entry.startNs, 0, 0]
+        if entry.durationNs is None or times[entry.index][1] is None:
+            times[entry.index][1] = None
+        else:
+            times[entry.index][1] += entry.durationNs
+        times[entry.index][2] += 1
+    return (times, plan.durationNs, plan.error)
+
+def mayBeHeader(blocks, index):
+    """ Checks if a block may contain a ZX Spectrum header, without reading its body """
+    return blocks.peek(index).id in (0x10, 0x11, 0x14) and blocks.bodyLength(index) in (None, 19)
+
+def headerBlocks(blocks):
+    """ Yields all blocks that may contain a ZX Spectrum header """
+    for ix in range(len(blocks)):
+        if mayBeHeader(blocks, ix):
+            yield blocks[ix]
+
 def main():
     parser = argparse.ArgumentParser(description='List the contents of a TZX file')
     parser.add_argument('file',
@@ -41,6 +71,15 @@ def main():
                 dest='verbose',
                 action='store_true',
                 help='show content of information blocks')
+    parser.add_argument('-t', '--times',
+                dest='times',
+                action='store_true',
+                help='show start time and playing time of each block')
+    parser.add_argument('-c', '--clock',
+                dest='clock',
+                default=3500000,
+                type=int,
+                help='Reference Z80 CPU clock, in Hz')
     args = parser.parse_args()
 
     files = list(args.file)
@@ -55,18 +94,45 @@ def main():
         if len(files) > 1:
             name = f.name if hasattr(f, 'name') else f
             print('\n%s:' % (name))
-        tzx = TzxFile()
-        tzx.read(f)
+        tzx = None
+        times = None
+        if args.times:
+            tzx = TzxFile()
+            tzx.read(f)
+            blocks = tzx.blocks
+            try:
+                (times, total, error) = blockTimes(tzx, args.clock)
+            except (IndexError, IOError, NotImplementedError) as ex:
+                print('Cannot compute playing times: %s' % (ex), file=sys.stderr)
+        elif args.short and not args.verbose and f.seekable():
+            tzx = TzxFile()
+            tzx.read(f, lazy=True)
+            blocks = headerBlocks(tzx.blocks)
+        else:
+            blocks = TzxFile.iterBlocks(f)
 
-        cnt = 0
-        for b in tzx.blocks:
+        for (cnt, b) in enumerate(blocks):
+            prefix = ''
+            if times is not None:
+                if times[cnt] is None:
+                    prefix = '%-9s  %-9s %4s  ' % ('-', '-', '')
+                else:
+                    (start, duration, plays) = times[cnt]
+                    prefix = '%9s  %9s %4s  ' % (formatTime(start), formatTime(duration) if duration is not None else '?', '%dx' % (plays) if plays > 1 else '')
             if args.short:
                 if hasattr(b, 'tap') and isinstance(b.tap, TapHeader):
-                    print('%s: %s' % (b.tap.type(), b.tap.name()))
+                    print('%s%s: %s' % (prefix, b.tap.type(), b.tap.name()))
             else:
-                print('%3d  %-27s %s' % (cnt, b.type, str(b)))
+                print('%3d  %s%-27s %s' % (cnt, prefix, b.type, str(b)))
             if args.verbose:
                 info = b.info()
                 if info is not None:
                     print(textwrap.indent(info.strip(), '\t'))
-            cnt += 1
+        if tzx is not None:
+            tzx.close()
+
+        if times is not None:
+            if error is not None:
+                print('Total playing time: unknown, playback stops after %s (%s)' % (formatTime(total), error))
+            else:
+                print('Total playing time: %s' % (formatTime(total)))
@@ -22,7 +22,7 @@
 import argparse
 import sys
 
-from tzxlib.tzxfile import TzxFile
+from tzxlib.tzxfile import TzxFile, TzxWriter
 
 def main():
     parser = argparse.ArgumentParser(description='Merges TZX files')
@@ -38,11 +38,14 @@ def main():
                 help='target TZX file, stdout if omitted')
     args = parser.parse_args()
 
-    file = TzxFile()
-
-    for f in args.files:
-        mergeFile = TzxFile()
-        mergeFile.read(f)
-        file.blocks.extend(mergeFile.blocks)
-
-    file.write(args.to)
+    with TzxWriter(args.to) as tzx:
+        for f in args.files:
+            if f.seekable():
+                # Copy the blocks without parsing them
+                mergeFile = TzxFile()
+                mergeFile.read(f, lazy=True)
+                tzx.copy(mergeFile.blocks, range(len(mergeFile.blocks)))
+                mergeFile.close()
+            else:
+                for b in TzxFile.iterBlocks(f):
+                    tzx.write(b)
@@ -20,29 +20,37 @@
 #
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from math import sin, pi
+import mmap
 import numpy
-import sounddevice as sd
+import os.path
 import struct
 import sys
 import time
 import wave
 
+from tzxlib.audiocache import AudioCache, RenderedAudio
+from tzxlib.playplan import PlaybackPlan
 from tzxlib.tapfile import TapHeader
 from tzxlib.tzxfile import TzxFile
-from tzxlib.tzxblocks import TzxbLoopStart, TzxbLoopEnd, TzxbJumpTo, TzxbPause, TzxbStopTape48k
-from tzxlib.saver import TapeSaver
+from tzxlib.saver import TapeSaver, FastLoadSaver
 
 
-wavelets = {}
+WAV_HEADER_SIZE = 44
+
+audioCache = AudioCache()
 silence = bytes(2048)
-numpySilence = numpy.zeros(1024, dtype=numpy.float32)
+
+frameSize = 0x4000      # number of samples of a yielded audio frame
+pulseChunk = 0x10000    # maximum number of pulses that are rendered at once
 
 
 def wavelet(length, level, sine=False, npy=False):
-    type = (length, level)
-    if type in wavelets:
-        return wavelets[type]
+    type = ('wavelet', length, level, sine, npy)
+    cached = audioCache.get(type)
+    if cached is not None:
+        return cached
 
     sign = 1 if level else -1
 
@@ -51,7 +59,6 @@ def wavelet(length, level, sine=False, npy=False):
         wave = numpy.empty(length, dtype=numpy.float32)
         for pos in range(length):
             wave[pos] = amp * sin(pos * pi / length) if sine else amp
-        wavelets[type] = wave
 
     else:
         amp = sign * (min(32767 * (length + 10) / 25, 32767) if sine else 32000)
@@ -59,87 +66,261 @@ def wavelet(length, level, sine=False, npy=False):
         for pos in range(length):
             value = int(amp * sin(pos * pi / length) if sine else amp)
             wave[pos*2:pos*2+2] = struct.pack('<h', value)
-            wavelets[type] = bytes(wave)
-    return wavelets[type]
+        wave = bytes(wave)
+    audioCache.put(type, wave)
+    return wave
 
 
-def streamAudio(tzx:TzxFile, rate=44100, stopAlways=False, stop48k=False, sine=False, cpufreq=3500000, verbose=False, npy=False):
-    saver = TapeSaver(cpufreq)
+class PulseRenderer():
+    """
+    Renders pulse lengths to audio samples. The pulse lengths are given in
+    samples, as generated by a sample based TapeSaver. The samples of all pulses
+    of a chunk are copied from the precomputed wavelets in a single step.
+    """
 
-    block = 0
-    repeatBlock = None
-    repeatCount = None
-    currentSampleTime = 0
-    realTimeNs = 0
+    def __init__(self, rate=44100, sine=False, npy=False):
+        self.rate = rate
+        self.sine = sine
+        self.npy = npy
+        self.dtype = numpy.float32 if npy else numpy.dtype('<i2')
+        self.startBlock()
 
-    while block < len(tzx.blocks):
-        b = tzx.blocks[block]
-        if verbose:
-            millis = realTimeNs // 1000000
-            seconds = millis // 1000
-            minutes = seconds // 60
-            print('%02d:%02d.%03d %3d %-30s %s' % (minutes, seconds%60, millis%1000, block, b.type, str(b)))
-        block += 1
-
-        if isinstance(b, TzxbLoopStart):
-            repeatBlock = block
-            repeatCount = b.repeats()
-            continue
-        elif isinstance(b, TzxbLoopEnd) and repeatBlock is not None:
-            repeatCount -= 1
-            if repeatCount > 0:
-                block = repeatBlock
-                if verbose:
-                    print('    - returning to block %d (remaining %d)' % (block, repeatCount))
+    def startBlock(self):
+        """ Starts a new block, the signal level starts low """
+        self.toggles = 0
+        self.lastLevel = False
+
+    def render(self, pulses):
+        """ Renders an array of pulse lengths in samples, returns an array of samples """
+        # Each pulse toggles the level, even if it has a length of 0
+        levels = (numpy.arange(len(pulses)) + self.toggles) % 2 == 0
+        self.toggles += len(pulses)
+
+        # Skip pulses that are shorter than a sample
+        emit = pulses > 0
+        lengths = pulses[emit]
+        levels = levels[emit]
+        if len(lengths) == 0:
+            return numpy.zeros(0, dtype=self.dtype)
+
+        # A wavelet is generated on level changes, silence otherwise
+        changes = levels != numpy.concatenate(([self.lastLevel], levels[:-1]))
+        self.lastLevel = bool(levels[-1])
+        keys = numpy.where(changes, lengths * 2 + levels, -1)
+
+        # Copy all required wavelets into a bank, and fill the samples from it
+        (unique, inverse) = numpy.unique(keys, return_inverse=True)
+        pieces = []
+        offsets = []
+        offset = 0
+        for key in unique.tolist():
+            if key < 0:
+                piece = numpy.zeros(int(lengths.max()), dtype=self.dtype)
+            elif self.npy:
+                piece = wavelet(key >> 1, key & 1 == 1, self.sine, self.npy)
             else:
-                repeatBlock = None
-                repeatCount = None
-                if verbose:
-                    print('    - loop is finished')
+                piece = numpy.frombuffer(wavelet(key >> 1, key & 1 == 1, self.sine, self.npy), dtype=self.dtype)
+            pieces.append(piece)
+            offsets.append(offset)
+            offset += len(piece)
+        bank = numpy.concatenate(pieces)
+
+        starts = numpy.cumsum(lengths) - lengths
+        index = numpy.repeat(numpy.array(offsets)[inverse.ravel()] - starts, lengths) + numpy.arange(int(lengths.sum()))
+        return bank[index]
+
+
+def streamAudio(tzx:TzxFile, rate=44100, stopAlways=False, stop48k=False, sine=False, cpufreq=3500000, verbose=False, npy=False, cache=None, fromBlock=None, fromNs=None, fastLoad=False, fastBits=False):
+    """
+    Renders the TZX file to audio. Yields frames of frameSize samples, as float32
+    arrays if npy is set, or as 16 bit PCM bytes otherwise. Playback starts at
+    the given block index or time in ns, if set. fastLoad and fastBits select
+    the fast loading mode, see FastLoadSaver.
+    """
+    pending = []
+    pendingLength = 0
+    for samples in streamSamples(tzx, rate, stopAlways, stop48k, sine, cpufreq, verbose, npy, cache, fromBlock, fromNs, fastLoad, fastBits):
+        pending.append(samples)
+        pendingLength += len(samples)
+        if pendingLength < frameSize:
             continue
-        elif isinstance(b, TzxbJumpTo):
-            block += b.relative()-1
-            if block < 0 or block > len(tzx.blocks)-1:
-                raise IndexError('Jump to non-existing block')
-            if verbose:
-                print('    - jumping to block %d' % (block))
+        data = numpy.concatenate(pending)
+        frameCount = len(data) // frameSize
+        for ix in range(frameCount):
+            frame = data[ix * frameSize:(ix + 1) * frameSize]
+            yield frame if npy else frame.tobytes()
+        pending = [data[frameCount * frameSize:]]
+        pendingLength = len(pending[0])
+    if pendingLength > 0:
+        data = numpy.concatenate(pending)
+        yield data if npy else data.tobytes()
+
+
+def streamSamples(tzx:TzxFile, rate=44100, stopAlways=False, stop48k=False, sine=False, cpufreq=3500000, verbose=False, npy=False, cache=None, fromBlock=None, fromNs=None, fastLoad=False, fastBits=False):
+    """ Renders the TZX file to audio. Yields arrays of samples of any length. """
+    saver = createSaver(cpufreq, fastLoad, fastBits, rate)
+    plan = PlaybackPlan(tzx, cpufreq, stopAlways, stop48k, saver)
+    (first, skip) = startOf(plan, rate, fromBlock, fromNs)
+    if first is None:
+        return
+
+    renderer = PulseRenderer(rate, sine, npy)
+    for entry in plan.entries[first:]:
+        if verbose:
+            showEntry(entry)
+        if not entry.play:
             continue
-        elif isinstance(b, TzxbPause) and b.stopTheTape() and stopAlways:
-            if verbose:
-                print('    - tape stopped')
-            break
-        elif isinstance(b, TzxbStopTape48k) and stop48k:
-            if verbose:
-                print('    - tape stopped (48k mode)')
-            break
-
-        currentLevel = False
-        lastLevel = False
-        for ns in b.playback(saver):
-            currentLevel = not currentLevel
-            if ns > 0:
-                realTimeNs += ns
-                newSampleTime = ((realTimeNs * rate) + 500000000) // 1000000000
-                wavelen = newSampleTime - currentSampleTime
-                if wavelen <= 0:
-                    continue
-                if currentLevel != lastLevel:
-                    yield wavelet(wavelen, currentLevel, sine, npy)
-                else:
-                    while wavelen > 0:
-                        if wavelen >= len(silence)//2:
-                            yield numpySilence if npy else silence
-                            wavelen -= len(silence)//2
-                        else:
-                            yield numpy.zeros(wavelen, dtype=numpy.float32) if npy else silence[0:wavelen*2]
-                            wavelen = 0
-                lastLevel = currentLevel
-                currentSampleTime = newSampleTime
+        saver.currentState = entry.startState
+        saver.ticks = entry.startTicks
+        for samples in renderBlock(entry.block, saver, renderer, cache):
+            if skip > 0:
+                # Drop the part of the first block that is before the start time
+                dropped = min(skip, len(samples))
+                samples = samples[dropped:]
+                skip -= dropped
+            if len(samples) > 0:
+                yield samples
+    if verbose:
+        showTime(plan.durationNs, '    End of Recording')
+
+
+def createSaver(cpufreq=3500000, fastLoad=False, fastBits=False, rate=None):
+    """ Creates the TapeSaver for the selected loading mode """
+    if fastLoad or fastBits:
+        return FastLoadSaver(cpufreq, fastBits, rate)
+    return TapeSaver(cpufreq, rate)
+
+
+def startOf(plan, rate, fromBlock=None, fromNs=None):
+    """
+    Returns the position of the first played entry of the plan, and the number of
+    samples to be skipped at its start. The position is None if nothing is played.
+    """
+    if fromBlock is not None:
+        return (plan.findBlock(fromBlock), 0)
+    if fromNs is not None:
+        if fromNs >= plan.durationNs:
+            return (None, 0)
+        first = plan.findTime(fromNs)
+        fromSample = (fromNs * rate + 500000000) // 1000000000
+        return (first, max(fromSample - plan.entries[first].startSample, 0))
+    return (0, 0) if plan.entries else (None, 0)
+
+
+def renderBlock(block, saver, renderer, cache=None):
+    """ Renders a single block. Yields arrays of samples. If a cache is given, it is used. """
+    key = None
+    if cache is not None:
+        key = cache.blockKey(block, renderer.rate, saver.cpufreq, renderer.sine, renderer.npy,
+                             saver.currentState, saver.ticks % saver.cpufreq, saver.variant)
+        cached = cache.get(key)
+        if cached is not None:
+            saver.currentState = cached.endState
+            saver.ticks += cached.ticks
+            if len(cached.samples) > 0:
+                yield cached.samples
+            return
+
+    startTicks = saver.ticks
+    rendered = []
+    renderer.startBlock()
+    for pulses in block.playback(saver):
+        for ix in range(0, len(pulses), pulseChunk):
+            samples = renderer.render(pulses[ix:ix + pulseChunk])
+            if len(samples) > 0:
+                if key is not None:
+                    rendered.append(samples)
+                yield samples
+
+    if key is not None and rendered:
+        cache.put(key, RenderedAudio(numpy.concatenate(rendered), saver.ticks - startTicks, saver.currentState))
+
+
+def showEntry(entry):
+    b = entry.block
+    showTime(entry.startNs, '%3d %-30s %s' % (entry.index, b.type, str(b)))
+    if entry.note is not None:
+        print('    - %s' % (entry.note))
+
+
+def showTime(ns, text):
+    print('%s %s' % (formatTime(ns), text))
+
+
+def formatTime(ns):
+    millis = ns // 1000000
+    seconds = millis // 1000
+    minutes = seconds // 60
+    return '%02d:%02d.%03d' % (minutes, seconds%60, millis%1000)
+
+
+def parseTime(text):
+    """ Parses a time of the format [mm:]ss[.fff], returns the time in ns """
+    try:
+        (minutes, _, seconds) = text.rpartition(':')
+        return round((int(minutes or 0) * 60 + float(seconds)) * 1000000000)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid time: %s' % (text))
+
+
+def exportWav(tzx:TzxFile, filename, jobs, rate=44100, stopAlways=False, stop48k=False, sine=False, cpufreq=3500000, verbose=False, cacheDir=None, fromBlock=None, fromNs=None, fastLoad=False, fastBits=False):
+    """
+    Renders the TZX file to a WAV file, using multiple processes. The start time
+    and signal level of each block is taken from the playback plan, then the
+    blocks are rendered in parallel, right into their place in the memory-mapped
+    WAV file.
+    """
+    plan = PlaybackPlan(tzx, cpufreq, stopAlways, stop48k, createSaver(cpufreq, fastLoad, fastBits, rate))
+    (first, skip) = startOf(plan, rate, fromBlock, fromNs)
+    entries = plan.entries[first:] if first is not None else []
     if verbose:
-        millis = realTimeNs // 1000000
-        seconds = millis // 1000
-        minutes = seconds // 60
-        print('%02d:%02d.%03d     End of Recording' % (minutes, seconds%60, millis%1000))
+        for entry in entries:
+            showEntry(entry)
+        showTime(plan.durationNs, '    End of Recording')
+
+    # Pre-size the WAV file, trailing with a short silence
+    originSample = entries[0].startSample + skip if entries else plan.endSample
+    frames = plan.endSample - originSample + len(silence[0:16]) // 2
+    with open(filename, 'wb') as out:
+        out.write(struct.pack('<4sL4s4sLHHLLHH4sL', b'RIFF', 36 + frames * 2, b'WAVE',
+                b'fmt ', 16, 1, 1, rate, rate * 2, 2, 16, b'data', frames * 2))
+        out.truncate(WAV_HEADER_SIZE + frames * 2)
+
+    # Split into sections of about the same playing time
+    originNs = entries[0].startNs if entries else 0
+    sectionNs = (plan.durationNs - originNs) // (jobs * 4) + 1
+    sections = [[]]
+    for entry in entries:
+        if not entry.play:
+            continue
+        if sections[-1] and entry.startNs - originNs >= len(sections) * sectionNs:
+            sections.append([])
+        sections[-1].append((entry.block, entry.startTicks, entry.startSample, entry.startState))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_renderSection, filename, section, originSample, rate, sine, cpufreq, cacheDir, fastLoad, fastBits) for section in sections if section]
+        for future in futures:
+            future.result()
+
+
+def _renderSection(filename, section, originSample, rate, sine, cpufreq, cacheDir, fastLoad, fastBits):
+    cache = AudioCache(directory=cacheDir)
+    with open(filename, 'r+b') as f, mmap.mmap(f.fileno(), 0) as out:
+        for (block, startTicks, startSample, state) in section:
+            saver = createSaver(cpufreq, fastLoad, fastBits, rate)
+            saver.ticks = startTicks
+            saver.currentState = state
+            renderer = PulseRenderer(rate, sine)
+            pos = WAV_HEADER_SIZE + (startSample - originSample) * 2
+            for samples in renderBlock(block, saver, renderer, cache):
+                data = samples.tobytes()
+                if pos < WAV_HEADER_SIZE:
+                    # Drop the part of the first block that is before the start time
+                    dropped = min(WAV_HEADER_SIZE - pos, len(data))
+                    data = data[dropped:]
+                    pos += dropped
+                out[pos:pos + len(data)] = data
+                pos += len(data)
 
 
 def main():
@@ -181,6 +362,35 @@ def main():
                 dest='sine',
                 action='store_true',
                 help='Generate soft sine pulses (square pulses otherwise)')
+    parser.add_argument('-C', '--cache',
+                dest='cache',
+                metavar='DIR',
+                default=None,
+                help='Directory for caching rendered blocks')
+    parser.add_argument('-j', '--jobs',
+                dest='jobs',
+                default=1,
+                type=int,
+                help='Number of parallel jobs for generating a WAV file')
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument('-b', '--from-block',
+                dest='fromBlock',
+                metavar='BLOCK',
+                type=int,
+                help='Start playback at this block number')
+    start.add_argument('-t', '--from-time',
+                dest='fromTime',
+                metavar='TIME',
+                type=parseTime,
+                help='Start playback at this time, as mm:ss')
+    parser.add_argument('-f', '--fast',
+                dest='fast',
+                action='store_true',
+                help='Shorten leader tones and pauses for faster loading')
+    parser.add_argument('-F', '--fast-bits',
+                dest='fastBits',
+                action='store_true',
+                help='Like --fast, also shorten the bits of standard speed blocks')
     args = parser.parse_args()
 
     if args.file is None:
@@ -189,8 +399,35 @@ def main():
 
     tzx = TzxFile()
     tzx.read(args.file)
+
+    if args.fast or args.fastBits:
+        try:
+            normal = PlaybackPlan(tzx, args.clock, args.stop, args.mode48k)
+            fast = PlaybackPlan(tzx, args.clock, args.stop, args.mode48k, createSaver(args.clock, True, args.fastBits))
+        except (IndexError, IOError, NotImplementedError) as ex:
+            print('Error: %s' % (ex), file=sys.stderr)
+            sys.exit(1)
+        print('Fast loading, playing time %s instead of %s' % (formatTime(fast.durationNs), formatTime(normal.durationNs)), file=sys.stderr)
+
+    name = getattr(args.to, 'name', None)
+    if args.jobs > 1 and isinstance(name, str) and os.path.isfile(name):
+        args.to.close()
+        try:
+            exportWav(tzx, name, args.jobs, rate=args.rate, stopAlways=args.stop, stop48k=args.mode48k,
+                      sine=args.sine, cpufreq=args.clock, verbose=args.verbose, cacheDir=args.cache,
+                      fromBlock=args.fromBlock, fromNs=args.fromTime, fastLoad=args.fast, fastBits=args.fastBits)
+        except (IndexError, IOError, NotImplementedError) as ex:
+            print('Error: %s' % (ex), file=sys.stderr)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            print('', file=sys.stderr)
+            print("D BREAK - CONT repeats, 0:1", file=sys.stderr)
+        return
+
     stream = streamAudio(tzx, rate=args.rate, stopAlways=args.stop, stop48k=args.mode48k,
-                        sine=args.sine, cpufreq=args.clock, verbose=args.verbose, npy=args.to is None)
+                        sine=args.sine, cpufreq=args.clock, verbose=args.verbose, npy=args.to is None,
+                        cache=AudioCache(directory=args.cache), fromBlock=args.fromBlock, fromNs=args.fromTime,
+                        fastLoad=args.fast, fastBits=args.fastBits)
 
     audiostream = audio = wav = None
 
@@ -206,9 +443,13 @@ def main():
             wav.writeframesraw(silence[0:16])
         else:
             # Audio Playback
+            import sounddevice as sd
             with sd.Stream(samplerate=args.rate, channels=1, latency='high') as out:
                 for b in stream:
                     out.write(b)
+    except (IndexError, IOError, NotImplementedError) as ex:
+        print('Error: %s' % (ex), file=sys.stderr)
+        sys.exit(1)
     except KeyboardInterrupt:
         print('', file=sys.stderr)
         print("D BREAK - CONT repeats, 0:1", file=sys.stderr)
@@ -41,9 +41,9 @@ def writeBlock(block, out, ignore, index):
             print('Use --ignore option to enforce conversion, but TAP file will be faulty.', file=sys.stderr)
             exit(1)
 
-def writeAllBlocks(tzx, out, ignore):
+def writeAllBlocks(blocks, out, ignore):
     index = 0
-    for block in tzx.blocks:
+    for block in blocks:
         writeBlock(block, out, ignore, index)
         index += 1
 
@@ -70,9 +70,6 @@ def main():
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    file = TzxFile()
-    file.read(args.file)
-
     outf = args.to if args.to != '-' else sys.stdout.buffer
     with outf if isinstance(outf, io.IOBase) else open(outf, 'wb') as tap:
-        writeAllBlocks(file, tap, args.ignore)
+        writeAllBlocks(TzxFile.iterBlocks(args.file), tap, args.ignore)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# tzxtools - a collection for processing tzx files
+#
+# Copyright (C) 2026 Richard "Shred" Körber
+#   https://codeberg.org/shred/tzxtools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import numpy
+import sys
+
+from tzxlib import trace as tr
+
+pulseTypes = { 'leader': tr.LEADER, 'sync': tr.SYNC, 'bit0': tr.BIT0, 'bit1': tr.BIT1 }
+
+
+def formatTime(frame, framerate):
+    millis = int(frame) * 1000 // framerate
+    return '{:3d}:{:02d}.{:03d}'.format(millis // 60000, (millis // 1000) % 60, millis % 1000)
+
+
+def showSummary(events):
+    print('Events: {}'.format(len(events)))
+    for event in (tr.PULSE, tr.REJECT):
+        selected = events[events['event'] == event]
+        for pulse in sorted(tr.PULSE_NAMES.keys()):
+            ofPulse = selected[selected['pulse'] == pulse]
+            reasons = numpy.bincount(ofPulse['reason'], minlength=len(tr.REASON_NAMES))
+            for reason in numpy.flatnonzero(reasons):
+                print('  {:7s} {:7s} {:16s} {:10d}'.format(
+                        tr.EVENT_NAMES[event],
+                        tr.PULSE_NAMES[pulse],
+                        tr.REASON_NAMES[int(reason)],
+                        reasons[reason]))
+    blocks = events[events['event'] == tr.BLOCK]
+    print('Blocks: {}, CRC errors: {}'.format(len(blocks), numpy.count_nonzero(blocks['value'] == 0)))
+
+
+def showRegions(events, framerate, seconds):
+    rejects = events[events['event'] == tr.REJECT]
+    pulses = events[events['event'] == tr.PULSE]
+    size = max(int(seconds * framerate), 1)
+    reasons = sorted(r for r in tr.REASON_NAMES.keys() if numpy.any(rejects['reason'] == r))
+    print('{:>10s} {:>10s}'.format('Region', 'Pulses') + ''.join(' {:>16s}'.format(tr.REASON_NAMES[r]) for r in reasons))
+    if len(events) == 0:
+        return
+    first = int(events['position'].min()) // size
+    last = int(events['position'].max()) // size
+    pulseCounts = numpy.bincount(pulses['position'] // size - first, minlength=last - first + 1)
+    rejectCounts = [numpy.bincount(rejects[rejects['reason'] == r]['position'] // size - first, minlength=last - first + 1) for r in reasons]
+    for ix in range(last - first + 1):
+        if pulseCounts[ix] == 0 and all(c[ix] == 0 for c in rejectCounts):
+            continue
+        print('{:10s} {:10d}'.format(formatTime((first + ix) * size, framerate), pulseCounts[ix])
+              + ''.join(' {:16d}'.format(c[ix]) for c in rejectCounts))
+
+
+def showHistogram(events, width):
+    pulses = events[events['event'] == tr.PULSE]
+    for pulse in sorted(tr.PULSE_NAMES.keys()):
+        lengths = pulses[pulses['pulse'] == pulse]['length']
+        if len(lengths) == 0:
+            continue
+        print('{} pulses: {}, mean {:.1f}, min {}, max {} T-states'.format(
+                tr.PULSE_NAMES[pulse], len(lengths), lengths.mean(), lengths.min(), lengths.max()))
+        counts = numpy.bincount(lengths // width)
+        maxCount = counts.max()
+        for ix in numpy.flatnonzero(counts):
+            print('  {:5d}-{:5d} {:9d} {}'.format(
+                    ix * width,
+                    (ix + 1) * width - 1,
+                    counts[ix],
+                    '#' * int(counts[ix] * 50 // maxCount)))
+
+
+def showEvents(events, framerate):
+    for ev in events:
+        print('{} {:9d} {:7s} {:7s} {:16s} len={:5d} amp={:5d} bias={:8.1f} val={:3d}'.format(
+                formatTime(ev['position'], framerate),
+                ev['position'],
+                tr.EVENT_NAMES.get(int(ev['event']), '?'),
+                tr.PULSE_NAMES.get(int(ev['pulse']), '?'),
+                tr.REASON_NAMES.get(int(ev['reason']), '?'),
+                ev['length'],
+                ev['amplitude'],
+                ev['bias'],
+                ev['value']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyzes a tzxwav trace file')
+    parser.add_argument('file',
+                nargs='?',
+                type=argparse.FileType('rb'),
+                default=(None if sys.stdin.isatty() else sys.stdin.buffer),
+                help='trace file, stdin if omitted')
+    parser.add_argument('-s', '--start',
+                dest='start',
+                type=int,
+                help='only events from this WAV frame number on')
+    parser.add_argument('-e', '--end',
+                dest='end',
+                type=int,
+                help='only events up to this WAV frame number')
+    parser.add_argument('-P', '--pulse',
+                dest='pulse',
+                choices=pulseTypes.keys(),
+                help='only events of this pulse type')
+    parser.add_argument('-r', '--regions',
+                dest='regions',
+                metavar='SECONDS',
+                type=float,
+                help='show pulses and rejection reasons by regions of the given length')
+    parser.add_argument('-H', '--histogram',
+                dest='histogram',
+                action='store_true',
+                help='show histograms of the accepted pulse lengths')
+    parser.add_argument('-w', '--width',
+                dest='width',
+                default=50,
+                type=int,
+                help='width of a histogram bin, in T-states')
+    parser.add_argument('-l', '--list',
+                dest='list',
+                action='store_true',
+                help='list all events')
+    args = parser.parse_args()
+
+    if args.file is None:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    (framerate, cpufreq, events) = tr.readTrace(args.file)
+    if args.start is not None:
+        events = events[events['position'] >= args.start]
+    if args.end is not None:
+        events = events[events['position'] <= args.end]
+    if args.pulse is not None:
+        events = events[events['pulse'] == pulseTypes[args.pulse]]
+
+    if args.list:
+        showEvents(events, framerate)
+    elif args.regions is not None:
+        showRegions(events, framerate, args.regions)
+    elif args.histogram:
+        showHistogram(events, max(args.width, 1))
+    else:
+        showSummary(events)
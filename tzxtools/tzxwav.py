@@ -21,11 +21,14 @@
 
 import argparse
 import io
+import os.path
 import sys
 from time import time
 import wave
 
-from tzxlib.loader import TapeLoader
+from tzxlib.loader import TapeLoader, PulseLoader
+from tzxlib.trace import TraceWriter
+from tzxlib.tzxfile import TzxWriter
 
 tresholds  = { 'low': 500, 'med': 2500, 'high':5000 }
 tolerances = { 'low': 1.1,  'med': 1.2,  'high': 1.4 }
@@ -104,10 +107,24 @@ def main():
                 default='mix',
                 dest='leftChMix',
                 help='channel selection (works only for stereo WAV files)')
+    parser.add_argument('-F', '--fast',
+                dest='fast',
+                action='store_true',
+                help='fast decoding of good quality recordings')
+    parser.add_argument('-j', '--jobs',
+                dest='jobs',
+                default=1,
+                type=int,
+                help='number of parallel decoding jobs')
     parser.add_argument('-D', '--debug',
                 dest='debug',
                 action='count',
                 help='enable debug output, give multiple times to increase verbosity')
+    parser.add_argument('--trace',
+                dest='trace',
+                metavar='TRACEFILE',
+                type=argparse.FileType('wb'),
+                help='record decoder events to a trace file, see tzxtrace')
 
     args = parser.parse_args()
 
@@ -115,25 +132,36 @@ def main():
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    loader = TapeLoader(debug=args.debug,
+    loaderClass = PulseLoader if args.fast else TapeLoader
+    loader = loaderClass(debug=args.debug,
             treshold=tresholds[args.treshold],
             tolerance=tolerances[args.tolerance],
             leaderMin=leaderMins[args.leader],
             leftChMix=leftChMix[args.leftChMix],
             cpufreq=args.clock,
             progress=showProgress if args.progress else None,
-            verbose=args.verbose)
+            verbose=args.verbose,
+            trace=TraceWriter(args.trace) if args.trace is not None else None)
 
     try:
-        tzx = loader.load(args.file, startFrame=args.start, endFrame=args.end)
+        name = getattr(args.file, 'name', None)
+        if args.jobs > 1 and args.trace is None and isinstance(name, str) and os.path.isfile(name):
+            blocks = loader.iterBlocksParallel(name, args.jobs, startFrame=args.start, endFrame=args.end)
+        else:
+            blocks = loader.iterBlocks(args.file, startFrame=args.start, endFrame=args.end)
         file = args.to
         if not isinstance(file, io.IOBase) and not file.lower().endswith('.tzx'):
             file += '.tzx'
-        tzx.write(file)
+        with TzxWriter(file, flush=True) as tzx:
+            for (block, startPos, endPos) in blocks:
+                tzx.write(block)
     except KeyboardInterrupt:
         print('', file=sys.stderr)
         print("D BREAK - CONT repeats, 0:1", file=sys.stderr)
         exit(1)
+    finally:
+        if loader.trace is not None:
+            loader.trace.close()
 
     if args.progress:
         print('', file=sys.stderr)